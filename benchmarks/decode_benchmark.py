@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+### BEGIN LICENSE
+# Copyright (c) 2015, Peter Levi <peterlevi@peterlevi.com>
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+"""
+Headless benchmark of the decode path: decode + scale throughput and latency for synthetic images
+of several sizes and formats, with several zoom margins and worker counts, comparing the old
+fork-a-Process-per-image approach with the DecodePool, and the DecodePool's decoders.
+Needs only GdkPixbuf (and Pillow for the pillow decoder), no display.
+Prints (or writes with --output) one JSON object with a result per configuration.
+"""
+
+import itertools
+import json
+import optparse
+import os
+import resource
+import select
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing import Process, Queue
+
+PROJECT_ROOT_DIRECTORY = os.path.abspath(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+)
+sys.path.insert(0, PROJECT_ROOT_DIRECTORY)
+
+from varietyslideshow.decoding import DecodePool, cover_size, decode, resolve_decoder  # isort:skip
+
+# fmt: off
+from gi.repository import GdkPixbuf, GLib  # isort:skip
+# fmt: on
+
+SAVE_OPTIONS = {
+    "jpg": ("jpeg", ["quality"], ["90"]),
+    "png": ("png", [], []),
+    "bmp": ("bmp", [], []),
+}
+
+
+def generate_image(path, width, height, image_format):
+    # random colors blown up with bilinear scaling: smooth gradients, generated in C rather than
+    # pixel by pixel in Python, and different for every image
+    small_w, small_h = 32, 24
+    small = GdkPixbuf.Pixbuf.new_from_bytes(
+        GLib.Bytes.new(os.urandom(small_w * small_h * 3)),
+        GdkPixbuf.Colorspace.RGB,
+        False,
+        8,
+        small_w,
+        small_h,
+        small_w * 3,
+    )
+    pixbuf = small.scale_simple(width, height, GdkPixbuf.InterpType.BILINEAR)
+    file_type, keys, values = SAVE_OPTIONS[image_format]
+    pixbuf.savev(path, file_type, keys, values)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def _fork_decode(job_id, filename, max_w, max_h, results):
+    # what VarietySlideshow.prepare_next_data used to do for every image, but at the size the
+    # pool's workers decode to, so that both modes do the same work
+    os.nice(20)
+    try:
+        pixels, info = decode(filename, *cover_size(filename, max_w, max_h))
+        results.put((job_id, (pixels,) + info))
+    except:
+        results.put((job_id, None))
+
+
+def run_fork(files, max_w, max_h, workers, decoder):
+    results = Queue()
+    started = {}
+    latencies = []
+    queue = list(files)
+    job_id = 0
+    while queue or started:
+        while queue and len(started) < workers:
+            p = Process(target=_fork_decode, args=(job_id, queue.pop(0), max_w, max_h, results))
+            p.daemon = True
+            started[job_id] = (time.monotonic(), p)
+            p.start()
+            job_id += 1
+        done_id, data = results.get()
+        start, p = started.pop(done_id)
+        latencies.append(time.monotonic() - start)
+        p.join()
+    return latencies
+
+
+def run_pool(files, max_w, max_h, workers, decoder):
+    # keep twice as many jobs in flight as workers, like a prefetch pipeline would
+    pool = DecodePool(workers, slots=2 * workers, decoder=decoder)
+    pool.start()
+    try:
+        started = {}
+        latencies = []
+        queue = list(files)
+        while queue or started:
+            while queue and pool.can_submit():
+                started[pool.submit(queue.pop(0), max_w, max_h)] = time.monotonic()
+            select.select([pool.fileno()], [], [], 1.0)
+            for job_id, filename, frame, _ in pool.collect():
+                if frame:
+                    pool.pixels(frame)  # the copy the UI makes before uploading
+                    pool.release(frame)
+                latencies.append(time.monotonic() - started.pop(job_id))
+        return latencies
+    finally:
+        pool.shutdown()
+        for process, _ in pool.workers:
+            process.join()
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]", description=__doc__.strip())
+    parser.add_option("--sizes", default="1920x1080,4000x3000", help="Image sizes, WxH,...")
+    parser.add_option("--formats", default="jpg,png,bmp", help="Image formats, jpg,png,bmp")
+    parser.add_option("--zooms", default="0,0.2", help="Zoom margins, as the --zoom option")
+    parser.add_option("--workers", default="1,2,4", help="Worker counts")
+    parser.add_option("--modes", default="fork,pool", help="fork, pool or both")
+    parser.add_option("--decoders", default="gdkpixbuf,pillow", help="Decoders for pool mode")
+    parser.add_option("--screen", default="1920x1080", help="Screen size to decode for")
+    parser.add_option("--images", type="int", default=8, help="Distinct images per size/format")
+    parser.add_option("--rounds", type="int", default=3, help="How many times to decode each")
+    parser.add_option("--output", help="Write the JSON results here instead of stdout")
+    options, args = parser.parse_args()
+
+    parse_size = lambda s: tuple(int(v) for v in s.lower().split("x"))
+    screen_w, screen_h = parse_size(options.screen)
+    folder = tempfile.mkdtemp(prefix="variety-slideshow-bench-")
+    results = []
+    try:
+        for size, image_format in itertools.product(
+            options.sizes.split(","), options.formats.split(",")
+        ):
+            width, height = parse_size(size)
+            files = []
+            for i in range(options.images):
+                path = os.path.join(folder, "%s-%d.%s" % (size, i, image_format))
+                generate_image(path, width, height, image_format)
+                files.append(path)
+
+            # fork mode is what we used to do, only with gdkpixbuf
+            modes = options.modes.split(",")
+            decoders = sorted(set(resolve_decoder(d) for d in options.decoders.split(",")))
+            runs = [("fork", "gdkpixbuf")] if "fork" in modes else []
+            runs += [("pool", decoder) for decoder in decoders] if "pool" in modes else []
+            for zoom, workers, (mode, decoder) in itertools.product(
+                options.zooms.split(","), options.workers.split(","), runs
+            ):
+                max_w = int(screen_w * (1 + 2 * float(zoom)))
+                max_h = int(screen_h * (1 + 2 * float(zoom)))
+                run = run_fork if mode == "fork" else run_pool
+                start = time.monotonic()
+                latencies = run(files * options.rounds, max_w, max_h, int(workers), decoder)
+                elapsed = time.monotonic() - start
+                results.append(
+                    {
+                        "mode": mode,
+                        "decoder": decoder,
+                        "size": size,
+                        "format": image_format,
+                        "zoom": float(zoom),
+                        "workers": int(workers),
+                        "images": len(latencies),
+                        "images_per_second": len(latencies) / elapsed,
+                        "latency_p50_ms": percentile(latencies, 50) * 1000,
+                        "latency_p95_ms": percentile(latencies, 95) * 1000,
+                        "latency_p99_ms": percentile(latencies, 99) * 1000,
+                    }
+                )
+                print(
+                    "%(mode)s/%(decoder)s %(size)s %(format)s zoom=%(zoom)s workers=%(workers)d: "
+                    "%(images_per_second).1f images/s, p95 %(latency_p95_ms).0f ms" % results[-1],
+                    file=sys.stderr,
+                )
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    # ru_maxrss is in kilobytes on Linux; the children figure covers the decode processes
+    report = {
+        "screen": options.screen,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "peak_children_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        "results": results,
+    }
+    if options.output:
+        with open(options.output, "w", encoding="utf8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
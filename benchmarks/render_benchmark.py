@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+### BEGIN LICENSE
+# Copyright (c) 2015, Peter Levi <peterlevi@peterlevi.com>
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+"""
+Frame pacing benchmark of the render path: runs a real VarietySlideshow on synthetic images for a
+fixed time, records a timestamp for every frame the Clutter stage paints, and reports dropped
+frames, the worst frame time and how much worse frames are during transitions, together with the
+time spent in go_next, texture upload, toggle and start_pan_and_zoom.
+Without a DISPLAY it re-runs itself under xvfb-run with software GL, so it works headless.
+Prints (or writes with --output) one JSON object.
+"""
+
+import functools
+import json
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+PROJECT_ROOT_DIRECTORY = os.path.abspath(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+)
+sys.path.insert(0, PROJECT_ROOT_DIRECTORY)
+
+from decode_benchmark import generate_image, percentile  # isort:skip
+
+TIMED_METHODS = (
+    "go_next",
+    "stage_next_slide",
+    "upload",
+    "initialize_pan_and_zoom",
+    "toggle",
+    "start_pan_and_zoom",
+)
+
+
+def parse_options():
+    parser = optparse.OptionParser(usage="%prog [options]", description=__doc__.strip())
+    parser.add_option("--duration", type="float", default=30, help="Seconds to run for")
+    parser.add_option("--seconds", default="2", help="Slideshow --seconds")
+    parser.add_option("--fade", default="0.4", help="Slideshow --fade")
+    parser.add_option("--zoom", default="0.2", help="Slideshow --zoom")
+    parser.add_option("--pan", default="0.05", help="Slideshow --pan")
+    parser.add_option("--image-size", default="4000x3000", help="Synthetic image size, WxH")
+    parser.add_option("--images", type="int", default=10, help="Number of synthetic images")
+    parser.add_option("--screen", default="1920x1080", help="Xvfb screen size, WxH")
+    parser.add_option("--low-power", action="store_true", help="Run the slideshow --low-power")
+    parser.add_option("--refresh", type="float", default=60, help="Refresh rate to judge against")
+    parser.add_option("--output", help="Write the JSON results here instead of stdout")
+    return parser.parse_args()[0]
+
+
+def rerun_under_xvfb(options):
+    env = dict(os.environ, LIBGL_ALWAYS_SOFTWARE="1")
+    command = ["xvfb-run", "-a", "-s", "-screen 0 %sx24" % options.screen]
+    sys.exit(subprocess.call(command + [sys.executable] + sys.argv, env=env))
+
+
+def timed(method, timings):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        start = time.monotonic()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            timings.setdefault(method.__name__, []).append(time.monotonic() - start)
+
+    return wrapper
+
+
+def analyze(frames, transitions, fade_time, refresh):
+    expected = 1 / refresh
+    intervals = [b - a for a, b in zip(frames, frames[1:])]
+    in_transition = [
+        b - a
+        for a, b in zip(frames, frames[1:])
+        if any(start <= b <= start + fade_time for start in transitions)
+    ]
+    dropped = sum(max(0, round(interval / expected) - 1) for interval in intervals)
+    summary = lambda values: {
+        "frames": len(values),
+        "mean_ms": sum(values) / len(values) * 1000,
+        "p95_ms": percentile(values, 95) * 1000,
+        "p99_ms": percentile(values, 99) * 1000,
+        "worst_ms": max(values) * 1000,
+    }
+    return {
+        "dropped_frames": dropped,
+        "dropped_ratio": dropped / max(1, dropped + len(intervals)),
+        "all_frames": summary(intervals) if intervals else None,
+        "transition_frames": summary(in_transition) if in_transition else None,
+    }
+
+
+def main():
+    options = parse_options()
+    if not os.environ.get("DISPLAY"):
+        rerun_under_xvfb(options)
+
+    # keep the slideshow's saved options, index and cache away from the user's real ones
+    home = tempfile.mkdtemp(prefix="variety-slideshow-bench-")
+    os.environ["HOME"] = home
+    folder = os.path.join(home, "images")
+    os.makedirs(folder)
+    width, height = (int(v) for v in options.image_size.lower().split("x"))
+    for i in range(options.images):
+        generate_image(os.path.join(folder, "%d.jpg" % i), width, height, "jpg")
+
+    sys.argv = [
+        "variety-slideshow",
+        "--defaults",
+        "--mode=fullscreen",
+        "--seconds=%s" % options.seconds,
+        "--fade=%s" % options.fade,
+        "--zoom=%s" % options.zoom,
+        "--pan=%s" % options.pan,
+        "--cache-size=0",
+        "--low-power" if options.low_power else "--dont-low-power",
+        folder,
+    ]
+    from varietyslideshow.varietyslideshow import SlideshowWindow, VarietySlideshow
+    from gi.repository import GLib
+
+    frames = []
+    transitions = []
+    timings = {}
+
+    class InstrumentedWindow(SlideshowWindow):
+        def connect_signals(self):
+            super().connect_signals()
+            self.stage.connect("after-paint", lambda *args: frames.append(time.monotonic()))
+
+        def toggle(self, texture, visible):
+            if visible:
+                transitions.append(time.monotonic())
+            return super().toggle(texture, visible)
+
+    for name in TIMED_METHODS:
+        method = getattr(InstrumentedWindow, name)
+        setattr(InstrumentedWindow, name, timed(method, timings))
+
+    class InstrumentedSlideshow(VarietySlideshow):
+        def new_window(self, monitor, monitor_size):
+            return InstrumentedWindow(self, monitor, monitor_size)
+
+    slideshow = InstrumentedSlideshow()
+    GLib.timeout_add(int(options.duration * 1000), slideshow.quit)
+    try:
+        slideshow.run()
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+    # only judge the steady state, from the first transition on
+    frames = [t for t in frames if transitions and t >= transitions[0]]
+    report = {
+        "options": vars(options),
+        "transitions": len(transitions),
+        "frame_pacing": analyze(frames, transitions, slideshow.fade_time / 1000, options.refresh),
+        "method_timings_ms": {
+            name: {
+                "calls": len(values),
+                "mean": sum(values) / len(values) * 1000,
+                "worst": max(values) * 1000,
+            }
+            for name, values in timings.items()
+        },
+    }
+    if options.output:
+        with open(options.output, "w", encoding="utf8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
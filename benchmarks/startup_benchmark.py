@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+### BEGIN LICENSE
+# Copyright (c) 2015, Peter Levi <peterlevi@peterlevi.com>
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+"""
+Startup benchmark: how long "variety-slideshow --help" takes, and the time from starting a
+slideshow process to the first image being painted, both on a cold start (no folder index or
+scaled image cache yet) and on warm starts that have them. Every run is a fresh process.
+Without a DISPLAY it re-runs itself under xvfb-run with software GL, so it works headless.
+Prints (or writes with --output) one JSON object.
+"""
+
+import json
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+PROJECT_ROOT_DIRECTORY = os.path.abspath(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+)
+sys.path.insert(0, PROJECT_ROOT_DIRECTORY)
+
+LAUNCHER = os.path.join(PROJECT_ROOT_DIRECTORY, "bin", "variety-slideshow")
+
+
+def parse_options():
+    parser = optparse.OptionParser(usage="%prog [options]", description=__doc__.strip())
+    parser.add_option("--runs", type="int", default=5, help="Warm starts to measure")
+    parser.add_option("--image-size", default="4000x3000", help="Synthetic image size, WxH")
+    parser.add_option("--images", type="int", default=2000, help="Number of synthetic images")
+    parser.add_option("--folders", type="int", default=20, help="Folders to spread them over")
+    parser.add_option("--screen", default="1920x1080", help="Xvfb screen size, WxH")
+    parser.add_option("--timeout", type="float", default=60, help="Give up on a run after this")
+    parser.add_option("--output", help="Write the JSON results here instead of stdout")
+    parser.add_option("--child", action="store_true", help=optparse.SUPPRESS_HELP)
+    return parser.parse_args()
+
+
+def rerun_under_xvfb(options):
+    env = dict(os.environ, LIBGL_ALWAYS_SOFTWARE="1")
+    command = ["xvfb-run", "-a", "-s", "-screen 0 %sx24" % options.screen]
+    sys.exit(subprocess.call(command + [sys.executable] + sys.argv, env=env))
+
+
+def child(args):
+    """Runs the slideshow, prints when the first image got painted and quits"""
+    imported = time.monotonic()
+    sys.argv = ["variety-slideshow"] + args
+    from varietyslideshow.varietyslideshow import SlideshowWindow, VarietySlideshow
+    from gi.repository import GLib
+
+    result = {"import": time.monotonic() - imported}
+
+    class FirstImageWindow(SlideshowWindow):
+        def connect_signals(self):
+            super().connect_signals()
+            self.stage.connect("after-paint", self.on_after_paint)
+
+        def on_after_paint(self, *args):
+            if self.app.first_image_shown and "first_image" not in result:
+                result["first_image"] = time.monotonic()
+                GLib.idle_add(self.app.quit)
+
+    class FirstImageSlideshow(VarietySlideshow):
+        def new_window(self, monitor, monitor_size):
+            return FirstImageWindow(self, monitor, monitor_size)
+
+    FirstImageSlideshow().run()
+    print(json.dumps(result))
+
+
+def measure(command, env, timeout):
+    start = time.monotonic()
+    output = subprocess.check_output(command, env=env, timeout=timeout)
+    return start, time.monotonic() - start, output
+
+
+def main():
+    options, args = parse_options()
+    if options.child:
+        return child(args)
+    if not os.environ.get("DISPLAY"):
+        rerun_under_xvfb(options)
+
+    from decode_benchmark import generate_image
+
+    # keep the slideshow's saved options, index and cache away from the user's real ones
+    home = tempfile.mkdtemp(prefix="variety-slideshow-bench-")
+    env = dict(os.environ, HOME=home)
+    try:
+        folder = os.path.join(home, "images")
+        width, height = (int(v) for v in options.image_size.lower().split("x"))
+        # a few real images, the rest are copies: the scan cares about the count, not the pixels
+        originals = []
+        for i in range(options.images):
+            subfolder = os.path.join(folder, "%d" % (i % options.folders))
+            os.makedirs(subfolder, exist_ok=True)
+            path = os.path.join(subfolder, "%d.jpg" % i)
+            if len(originals) < 10:
+                generate_image(path, width, height, "jpg")
+                originals.append(path)
+            else:
+                shutil.copyfile(originals[i % len(originals)], path)
+
+        _, help_time, _ = measure([sys.executable, LAUNCHER, "--help"], env, options.timeout)
+
+        command = [sys.executable, os.path.realpath(__file__), "--child", "--"]
+        command += ["--defaults", "--mode=fullscreen", "--seconds=5", folder]
+        runs = []
+        for i in range(options.runs + 1):
+            start, total, output = measure(command, env, options.timeout)
+            result = json.loads(output.decode("utf8").strip().splitlines()[-1])
+            runs.append(
+                {
+                    "cold": i == 0,
+                    "import_ms": result["import"] * 1000,
+                    "first_image_ms": (result["first_image"] - start) * 1000,
+                    "process_ms": total * 1000,
+                }
+            )
+            print("%(first_image_ms).0f ms to the first image" % runs[-1], file=sys.stderr)
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+    warm = sorted(run["first_image_ms"] for run in runs[1:])
+    report = {
+        "options": vars(options),
+        "help_ms": help_time * 1000,
+        "cold_first_image_ms": runs[0]["first_image_ms"],
+        "warm_first_image_median_ms": warm[len(warm) // 2] if warm else None,
+        "runs": runs,
+    }
+    if options.output:
+        with open(options.output, "w", encoding="utf8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+### BEGIN LICENSE
+# Copyright (c) 2015, Peter Levi <peterlevi@peterlevi.com>
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from varietyslideshow.filetable import FileTable  # isort:skip
+
+
+def append_files(count):
+    """Seconds it takes to append count files to a single folder"""
+    table = FileTable()
+    start = time.perf_counter()
+    for i in range(count):
+        table.append("/photos/IMG_%06d.jpg" % i, 1000, 0.0)
+    return time.perf_counter() - start
+
+
+class FileTableTest(unittest.TestCase):
+    def test_append_scales_linearly_in_one_folder(self):
+        small, large = 10000, 80000
+        small_time = min(append_files(small) for _ in range(3))
+        large_time = min(append_files(large) for _ in range(3))
+        # linear would be 8x; a lookup per append makes it 64x
+        self.assertLess(large_time, small_time * (large / small) * 2.5)
+
+    def test_append_then_add_finds_existing(self):
+        table = FileTable()
+        ids = [table.append("/photos/%d.jpg" % i, i, 0.0) for i in range(100)]
+        self.assertEqual(ids, list(range(100)))
+        self.assertEqual(table.path(42), "/photos/42.jpg")
+        self.assertEqual(table.add("/photos/42.jpg", 7, 1.0), (42, False))
+        self.assertEqual(table.stat(42), (7, 1.0))
+        self.assertEqual(table.add("/photos/new.jpg"), (100, True))
+        self.assertEqual(len(table), 101)
+
+    def test_add_revives_removed(self):
+        table = FileTable()
+        file_id = table.append("/photos/a.jpg")
+        table.remove(file_id)
+        self.assertEqual(len(table), 0)
+        self.assertEqual(table.add("/photos/a.jpg"), (file_id, False))
+        self.assertEqual((len(table), table.good), (1, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
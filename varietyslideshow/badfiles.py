@@ -0,0 +1,93 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+### BEGIN LICENSE
+# Copyright (c) 2015, Peter Levi <peterlevi@peterlevi.com>
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+import json
+import logging
+import os
+
+
+class BadFiles:
+    """
+    Persistent list of the files that could not be decoded, keyed by path, size and mtime, so
+    they are left out from the next runs without paying for a decode attempt again. A file is
+    given another chance as soon as its size or mtime changes.
+    Read from the scan thread, changed and saved from the main thread only. The files that are
+    gone are looked for in the scan thread too, see gone.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}  # path -> [size, mtime]
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf8") as f:
+                self.files = json.load(f)["files"]
+        except FileNotFoundError:
+            pass
+        except:
+            logging.exception("Could not load the list of bad files %s" % self.path)
+
+    def save(self):
+        try:
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf8") as f:
+                json.dump({"files": self.files}, f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(tmp, self.path)
+        except:
+            logging.exception("Could not save the list of bad files %s" % self.path)
+
+    def gone(self):
+        """The listed paths that do not exist anymore, to pass to forget from the main loop"""
+        return [path for path in list(self.files) if not os.path.exists(path)]
+
+    def forget(self, paths):
+        """Forgets files that are gone, their paths may be reused for good files"""
+        for path in paths:
+            self.files.pop(path, None)
+        if paths:
+            self.save()
+
+    def is_bad(self, path, size, mtime):
+        return self.files.get(path) == [size, mtime]
+
+    def filter(self, files):
+        """
+        Returns the (path, size, mtime) in files that are not known to be bad. The listed files
+        are stat-ed again: the scan takes the stat of unchanged folders from the FolderIndex, and
+        that misses a file being rewritten in place.
+        """
+        good = []
+        for path, size, mtime in files:
+            if path in self.files:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                size, mtime = st.st_size, st.st_mtime
+                if self.is_bad(path, size, mtime):
+                    continue
+            good.append((path, size, mtime))
+        return good
+
+    def add(self, path, size, mtime):
+        if not self.is_bad(path, size, mtime):
+            self.files[path] = [size, mtime]
+            self.save()
+
+    def discard(self, path):
+        """Forgets a file that turned out to be good after all, e.g. after it was fixed"""
+        if self.files.pop(path, None) is not None:
+            self.save()
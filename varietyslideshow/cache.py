@@ -0,0 +1,100 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+### BEGIN LICENSE
+# Copyright (c) 2015, Peter Levi <peterlevi@peterlevi.com>
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+import hashlib
+import logging
+import os
+import struct
+
+# magic, has_alpha, width, height, rowstride, bpp - followed by rowstride * height bytes of pixels
+HEADER = struct.Struct("<4s?IIII")
+MAGIC = b"VSS2"
+
+
+class ScaledImageCache:
+    """
+    On-disk cache of already decoded and scaled pixel data, in a raw format that can be read
+    (or mmap-ed) straight into a pixel buffer. Entries are keyed by the file's path, mtime and size
+    and by the requested size, so a changed file or a different screen size is simply a miss.
+    The least recently used entries (by file mtime, bumped on every hit) are evicted when the
+    cache grows beyond max_bytes. Used from the decode worker processes.
+    """
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.written = max_bytes  # trim once on the first store
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, filename, max_w, max_h):
+        st = os.stat(filename)
+        key = "%s|%d|%d|%d|%d" % (filename, st.st_mtime_ns, st.st_size, max_w, max_h)
+        return os.path.join(self.folder, hashlib.sha1(key.encode("utf8")).hexdigest())
+
+    def load(self, filename, max_w, max_h, get_buffer):
+        """
+        Reads the cached pixels into get_buffer(size), a buffer of at least size bytes, and returns
+        (has_alpha, width, height, rowstride, bpp), or None if the image is not cached
+        """
+        path = self.path(filename, max_w, max_h)
+        try:
+            with open(path, "rb") as f:
+                magic, has_alpha, width, height, rowstride, bpp = HEADER.unpack(f.read(HEADER.size))
+                size = rowstride * height
+                if magic != MAGIC:
+                    return None
+                if f.readinto(memoryview(get_buffer(size))[:size]) != size:
+                    return None
+            os.utime(path)
+            return has_alpha, width, height, rowstride, bpp
+        except (OSError, struct.error):
+            return None
+
+    def store(self, filename, max_w, max_h, info, pixels):
+        try:
+            path = self.path(filename, max_w, max_h)
+            has_alpha, width, height, rowstride, bpp = info
+            tmp = "%s.%d.tmp" % (path, os.getpid())
+            with open(tmp, "wb") as f:
+                f.write(HEADER.pack(MAGIC, has_alpha, width, height, rowstride, bpp))
+                f.write(pixels)
+            os.replace(tmp, path)
+
+            self.written += HEADER.size + len(pixels)
+            if self.written >= self.max_bytes / 10:
+                self.trim()
+        except OSError:
+            logging.exception("Could not cache scaled image for %s" % filename)
+
+    def trim(self):
+        self.written = 0
+        entries = []
+        with os.scandir(self.folder) as it:
+            for entry in it:
+                try:
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+                except OSError:
+                    pass
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,549 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+### BEGIN LICENSE
+# Copyright (c) 2015, Peter Levi <peterlevi@peterlevi.com>
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+import ctypes
+import ctypes.util
+import heapq
+import logging
+import mmap
+import os
+import queue
+import shutil
+import signal
+import struct
+import tempfile
+import time
+from collections import namedtuple
+from multiprocessing import Lock, Pipe, Process, Queue
+
+# fmt: off
+import gi  # isort:skip
+gi.require_version('GdkPixbuf', '2.0')
+from gi.repository import GdkPixbuf, GLib  # isort:skip
+# fmt: on
+
+from .exif import SOF_MARKERS, SOS
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+SHM_DIR = "/dev/shm"
+# slot dirs are named after the pid of the UI process that owns them, see remove_orphaned_slots
+SLOT_DIR_PREFIX = "variety-slideshow-"
+
+PR_SET_PDEATHSIG = 1
+
+# how often an idle worker checks that the UI process is still there, for when it was not
+# killed along with it (see _die_with_parent)
+PARENT_CHECK_INTERVAL = 5
+
+# gdkpixbuf - new_from_file_at_scale for everything;
+# pillow - Pillow for JPEGs: draft() has libjpeg decode at 1/2, 1/4 or 1/8 of the size right away
+# (DCT scaling), so only the last, at most 2x, reduction is a real resample. Other formats and
+# files Pillow can't read go through gdkpixbuf;
+# auto - pillow if Pillow is installed, gdkpixbuf otherwise.
+DECODERS = ("auto", "gdkpixbuf", "pillow")
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# how much of the end of a PNG to look at for its IEND chunk
+TAIL_SIZE = 4096
+
+# Why a job failed: invalid - the file is not an image we can decode, it will fail the same way
+# until it changes; error - it could not be read, or decoding failed for another reason that may
+# be gone next time; crash - the worker decoding it died, e.g. killed for running out of memory
+INVALID = "invalid"
+ERROR = "error"
+CRASH = "crash"
+
+# Describes decoded pixels sitting in a SlotRing slot - this is all that travels between processes.
+# decode_time is in seconds, sent_at is the worker's time.monotonic() when it sent the frame.
+Frame = namedtuple("Frame", "slot has_alpha width height rowstride bpp decode_time cached sent_at")
+
+
+def slot_bytes(max_w, max_h):
+    # GdkPixbuf pads rows to 4 bytes, so 4 bytes per pixel plus padding covers both RGB and RGBA
+    return max(1, max_h) * (max(1, max_w) * 4 + 4)
+
+
+def cover_size(filename, cover_w, cover_h):
+    """
+    The size to scale an image to so that it covers cover_w x cover_h, like the slideshow shows
+    it. Images are never enlarged, the GPU does that for free.
+    """
+    _, width, height = GdkPixbuf.Pixbuf.get_file_info(filename)
+    if not width or not height:
+        return cover_w, cover_h  # let the decoder fail or fit it in the box
+    scale = min(1, max(cover_w / width, cover_h / height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def resolve_decoder(decoder):
+    """The decoder that will actually be used for the requested one"""
+    if decoder in ("auto", "pillow"):
+        return "pillow" if Image is not None else "gdkpixbuf"
+    return decoder
+
+
+def fit_size(width, height, max_w, max_h):
+    """The size new_from_file_at_scale scales to, preserving the aspect ratio"""
+    if height * max_w > width * max_h:
+        return max(1, int(0.5 + width * max_h / height)), max_h
+    return max_w, max(1, int(0.5 + height * max_w / width))
+
+
+class InvalidImage(Exception):
+    pass
+
+
+def _check_jpeg(f, size):
+    """Walks the JPEG segment headers up to the image data, only seeking past their contents"""
+    has_frame = False
+    f.seek(2)
+    while True:
+        header = f.read(4)
+        if len(header) < 4 or header[0] != 0xFF:
+            raise InvalidImage("truncated or corrupt JPEG headers")
+        if header[1] == 0xFF:
+            f.seek(-3, os.SEEK_CUR)  # fill byte before a marker
+            continue
+        if header[1] == SOS:
+            if not has_frame:
+                raise InvalidImage("JPEG without a frame header")
+            return
+        has_frame = has_frame or header[1] in SOF_MARKERS
+        f.seek(struct.unpack(">H", header[2:])[0] - 2, os.SEEK_CUR)
+        if f.tell() > size:
+            raise InvalidImage("truncated JPEG headers")
+
+
+def sniff(filename):
+    """
+    Cheap check that filename looks like a complete image, reading only its headers and its end.
+    Raises InvalidImage for empty files and ones that are not JPEG, PNG or BMP whatever their
+    name, JPEGs cut off in their headers, PNGs without their final IEND chunk and BMPs shorter
+    than their header says. A JPEG cut off in its image data gets through: it can't be told
+    from one with more data appended after its end (like motion photos) without reading it all.
+    """
+    with open(filename, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        head = f.read(len(PNG_SIGNATURE))
+        if head.startswith(b"\xff\xd8"):
+            _check_jpeg(f, size)
+        elif head == PNG_SIGNATURE:
+            f.seek(max(0, size - TAIL_SIZE))
+            if b"IEND" not in f.read():
+                raise InvalidImage("truncated PNG")
+        elif head.startswith(b"BM"):
+            if len(head) < 6 or struct.unpack_from("<I", head, 2)[0] > size:
+                raise InvalidImage("truncated BMP")
+        else:
+            raise InvalidImage("not a JPEG, PNG or BMP image")
+
+
+def _decode_gdkpixbuf(filename, max_w, max_h):
+    pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(filename, max_w, max_h, True)
+    info = (
+        pixbuf.get_has_alpha(),
+        pixbuf.get_width(),
+        pixbuf.get_height(),
+        pixbuf.get_rowstride(),
+        4 if pixbuf.get_has_alpha() else 3,
+    )
+    return pixbuf.get_pixels(), info
+
+
+def _decode_pillow(filename, max_w, max_h):
+    """Returns None for anything but JPEGs, where draft() doesn't help"""
+    try:
+        with Image.open(filename) as image:
+            if image.format != "JPEG":
+                return None
+            size = fit_size(image.width, image.height, max_w, max_h)
+            image.draft("RGB", size)
+            if image.mode != "RGB":
+                image = image.convert("RGB")
+            if image.size != size:
+                image = image.resize(size, Image.BILINEAR)
+            return image.tobytes(), (False, size[0], size[1], size[0] * 3, 3)
+    except OSError:
+        return None  # not something Pillow can read, let GdkPixbuf try
+
+
+def decode(filename, max_w, max_h, decoder="gdkpixbuf"):
+    """Returns (pixels, (has_alpha, width, height, rowstride, bpp)) scaled to fit max_w x max_h"""
+    if decoder == "pillow":
+        result = _decode_pillow(filename, max_w, max_h)
+        if result is not None:
+            return result
+    return _decode_gdkpixbuf(filename, max_w, max_h)
+
+
+def remove_orphaned_slots(parent):
+    """
+    Removes the slot dirs in parent left behind by slideshows that are gone without cleaning
+    up, e.g. after a SIGKILL or a crash - /dev/shm is memory, and it is only freed on reboot.
+    """
+    try:
+        names = os.listdir(parent)
+    except OSError:
+        return
+    for name in names:
+        if not name.startswith(SLOT_DIR_PREFIX):
+            continue
+        try:
+            pid = int(name[len(SLOT_DIR_PREFIX) :].split("-")[0])
+        except ValueError:
+            continue
+        path = os.path.join(parent, name)
+        try:
+            if os.stat(path).st_uid != os.getuid():
+                continue
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            logging.info("Removing shared memory of a slideshow that is gone: %s" % path)
+            shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            # gone already, or a live process of another user
+            pass
+
+
+class SlotRing:
+    """
+    A fixed number of pixel buffers shared between the UI process and the decode workers.
+    Each slot is a file in /dev/shm that both sides mmap. Slots grow on demand: when a slot is
+    handed out for a bigger stage, or by the worker holding it when the image it decoded needs
+    more room (see _map_slot). Each side remaps when it sees it grew. Only free slots are shrunk,
+    see shrink_free.
+    """
+
+    def __init__(self, count):
+        parent = SHM_DIR if os.path.isdir(SHM_DIR) else tempfile.gettempdir()
+        remove_orphaned_slots(parent)
+        self.dir = tempfile.mkdtemp(prefix="%s%d-" % (SLOT_DIR_PREFIX, os.getpid()), dir=parent)
+        self.maps = [None] * count
+        self.free = list(range(count))
+
+    def path(self, slot):
+        return os.path.join(self.dir, "slot-%d" % slot)
+
+    def acquire(self, nbytes):
+        if not self.free:
+            return None
+        slot = self.free.pop(0)
+        self._map(slot, nbytes)
+        return slot
+
+    def _map(self, slot, nbytes):
+        if self.maps[slot] is None or len(self.maps[slot]) < nbytes:
+            if self.maps[slot] is not None:
+                self.maps[slot].close()
+            with open(self.path(slot), "a+b") as f:
+                nbytes = max(nbytes, os.fstat(f.fileno()).st_size)
+                f.truncate(nbytes)
+                self.maps[slot] = mmap.mmap(f.fileno(), nbytes)
+        return self.maps[slot]
+
+    def release(self, slot):
+        if slot not in self.free:
+            self.free.append(slot)
+
+    def pixels(self, frame):
+        size = frame.rowstride * frame.height
+        return bytes(memoryview(self._map(frame.slot, size))[:size])
+
+    def size(self):
+        """Bytes of shared memory held by all slots, as the workers may have grown them"""
+        total = 0
+        for slot in range(len(self.maps)):
+            try:
+                total += os.path.getsize(self.path(slot))
+            except OSError:
+                pass
+        return total
+
+    def shrink_free(self):
+        """
+        Gives back the memory of the slots that are not in use. Workers may still have them
+        mapped, but only ever write to a slot after growing it for the job (see _map_slot).
+        """
+        for slot in self.free:
+            if self.maps[slot] is not None:
+                self.maps[slot].close()
+                self.maps[slot] = None
+                os.truncate(self.path(slot), 0)
+
+    def close(self):
+        for m in self.maps:
+            if m is not None:
+                m.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def _map_slot(maps, path, size=0):
+    """Maps the slot file at path in a worker, first growing it to size bytes if it is smaller"""
+    if os.path.getsize(path) < size:
+        os.truncate(path, size)
+    size = os.path.getsize(path)
+    if path not in maps or len(maps[path]) < size:
+        if path in maps:
+            maps[path].close()
+        with open(path, "r+b") as f:
+            maps[path] = mmap.mmap(f.fileno(), size)
+    return maps[path]
+
+
+def _die_with_parent():
+    """Has the kernel terminate this process when its parent dies, where it can (Linux)"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.prctl(PR_SET_PDEATHSIG, signal.SIGTERM)
+    except (OSError, AttributeError):
+        pass
+
+
+def _worker(jobs, results, results_lock, cache, decoder, parent):
+    _die_with_parent()
+    os.nice(20)
+    maps = {}
+    while True:
+        try:
+            job = jobs.get(timeout=PARENT_CHECK_INTERVAL)
+        except queue.Empty:
+            if os.getppid() != parent:
+                return  # the UI is gone without telling us, e.g. killed
+            continue
+        if job is None:
+            return
+        job_id, filename, cover_w, cover_h, slot, path = job
+        failure = None
+        try:
+            start = time.monotonic()
+            get_buffer = lambda size: _map_slot(maps, path, size)
+            info = cache.load(filename, cover_w, cover_h, get_buffer) if cache else None
+            cached = info is not None
+            if info is None:
+                sniff(filename)
+                pixels, info = decode(filename, *cover_size(filename, cover_w, cover_h), decoder)
+                get_buffer(len(pixels))[: len(pixels)] = pixels
+                if cache:
+                    cache.store(filename, cover_w, cover_h, info, pixels)
+            decode_time = time.monotonic() - start
+            frame = Frame(slot, *info, decode_time, cached, time.monotonic())
+        except (InvalidImage, GLib.Error, OSError) as e:
+            logging.warning("Could not open file %s: %s" % (filename, e))
+            frame = None
+            # GdkPixbuf reports read errors in the GFileError domain, bad data in its own - along
+            # with running out of memory, which says nothing about the file
+            is_invalid = isinstance(e, InvalidImage) or (
+                isinstance(e, GLib.Error)
+                and e.domain == "gdk-pixbuf-error-quark"
+                and e.code != GdkPixbuf.PixbufError.INSUFFICIENT_MEMORY
+            )
+            failure = INVALID if is_invalid else ERROR
+        except:
+            logging.exception("Could not open file %s" % filename)
+            frame = None
+            failure = ERROR
+        with results_lock:
+            results.send((job_id, filename, frame, failure))
+
+
+class DecodePool:
+    """
+    A fixed set of long-lived decoder processes. Jobs wait in the pool, ordered by their deadline,
+    and each worker is handed the most urgent one whenever it is idle - so jobs that are not
+    needed anymore can be cancelled before they start, and urgent ones don't queue behind ones
+    due later. Each worker has its own job queue, so that when one of them dies we know exactly
+    which jobs it took down with it: the oldest one is failed (that is the file it was decoding),
+    the rest are resubmitted to its replacement.
+    Workers decode into SlotRing slots and only send back a small Frame descriptor, over a single
+    pipe whose fd the UI can watch from its main loop (see fileno() and collect()).
+    If a ScaledImageCache is given, workers serve images from it and store new ones to it.
+    decoder is one of DECODERS.
+    """
+
+    def __init__(self, size, slots, cache=None, decoder="auto"):
+        self.size = max(1, size)
+        self.slots = SlotRing(slots)
+        self.cache = cache
+        self.decoder = resolve_decoder(decoder)
+        self.results_reader, self.results_writer = Pipe(duplex=False)
+        self.results_lock = Lock()
+        self.workers = [None] * self.size
+        self.waiting = {}  # job_id -> (deadline, job), not handed to a worker yet
+        self.deadlines = []  # heap of (deadline, job_id), entries not matching waiting are stale
+        self.pending = {}  # job_id -> (worker index, job), handed to a worker
+        self.dispatched_at = {}  # job_id -> time.monotonic() when it was handed to a worker
+        self.failed = []  # results for jobs lost with a dead worker, not yet collected
+        self.restarts = 0
+        self.next_job_id = 0
+
+    def start(self):
+        for i in range(self.size):
+            self._start_worker(i)
+
+    def _start_worker(self, i):
+        jobs = Queue()
+        process = Process(
+            target=_worker,
+            args=(
+                jobs,
+                self.results_writer,
+                self.results_lock,
+                self.cache,
+                self.decoder,
+                os.getpid(),
+            ),
+        )
+        process.daemon = True
+        process.start()
+        self.workers[i] = (process, jobs)
+
+    def _load(self, i):
+        return sum(1 for worker, _ in self.pending.values() if worker == i)
+
+    def can_submit(self):
+        return bool(self.slots.free)
+
+    def submit(self, filename, cover_w, cover_h, deadline=0):
+        """
+        Queues decoding filename scaled to cover cover_w x cover_h (see cover_size), to be done
+        by deadline, a time.monotonic() time. Jobs with the same deadline are done in order.
+        Returns the id of the new job, or None if there is no free slot to decode into.
+        """
+        slot = self.slots.acquire(slot_bytes(cover_w, cover_h))
+        if slot is None:
+            return None
+        job_id = self.next_job_id
+        self.next_job_id += 1
+        job = (job_id, filename, cover_w, cover_h, slot, self.slots.path(slot))
+        self.waiting[job_id] = (deadline, job)
+        heapq.heappush(self.deadlines, (deadline, job_id))
+        self._dispatch()
+        return job_id
+
+    def set_deadline(self, job_id, deadline):
+        """Moves the deadline of a job that has not started yet"""
+        if job_id in self.waiting and self.waiting[job_id][0] != deadline:
+            self.waiting[job_id] = (deadline, self.waiting[job_id][1])
+            heapq.heappush(self.deadlines, (deadline, job_id))
+
+    def started_at(self, job_id):
+        """When a job was handed to a worker, or None if it has not started yet"""
+        return self.dispatched_at.get(job_id)
+
+    def cancel(self, job_id):
+        """
+        Cancels a job that has not started yet and frees its slot, returns whether it did.
+        A started job runs to the end, its result still has to be released.
+        """
+        entry = self.waiting.pop(job_id, None)
+        if entry is None:
+            return False
+        self.slots.release(entry[1][4])
+        return True
+
+    def queue_length(self):
+        return len(self.waiting) + len(self.pending)
+
+    def _dispatch(self):
+        """Hands the most urgent waiting jobs to the idle workers"""
+        for i in range(self.size):
+            if self._load(i):
+                continue
+            while self.deadlines:
+                deadline, job_id = heapq.heappop(self.deadlines)
+                entry = self.waiting.get(job_id)
+                if entry is not None and entry[0] == deadline:
+                    break  # the others are stale: cancelled, or their deadline moved
+            else:
+                return
+            del self.waiting[job_id]
+            self.pending[job_id] = (i, entry[1])
+            self.dispatched_at[job_id] = time.monotonic()
+            self.workers[i][1].put(entry[1])
+
+    def check_workers(self):
+        for i, (process, jobs) in enumerate(self.workers):
+            if process.is_alive():
+                continue
+            logging.warning(
+                "Decode worker %d died with exit code %s, restarting it" % (i, process.exitcode)
+            )
+            lost = sorted(job_id for job_id, (worker, _) in self.pending.items() if worker == i)
+            jobs.close()
+            self._start_worker(i)
+            self.restarts += 1
+            for n, job_id in enumerate(lost):
+                _, job = self.pending[job_id]
+                if n == 0:
+                    self.failed.append((job_id, job[1], None, CRASH))
+                else:
+                    self.workers[i][1].put(job)
+
+    def fileno(self):
+        """The fd that becomes readable when decode results are available"""
+        return self.results_reader.fileno()
+
+    def collect(self):
+        """
+        Returns all (job_id, filename, frame, failure) results available right now, without
+        blocking. If decoding failed, frame is None and failure is INVALID, ERROR or CRASH.
+        Otherwise the frame's slot must be given back with release() once its pixels have been
+        used.
+        """
+        self.check_workers()
+        results, self.failed = self.failed, []
+        while self.results_reader.poll():
+            results.append(self.results_reader.recv())
+
+        collected = []
+        for job_id, filename, frame, failure in results:
+            entry = self.pending.pop(job_id, None)
+            self.dispatched_at.pop(job_id, None)
+            if entry is None:
+                continue  # a late duplicate of a job check_workers already failed
+            if frame is None:
+                self.slots.release(entry[1][4])
+            collected.append((job_id, filename, frame, failure))
+        self._dispatch()
+        return collected
+
+    def pixels(self, frame):
+        return self.slots.pixels(frame)
+
+    def release(self, frame):
+        self.slots.release(frame.slot)
+
+    def memory_size(self):
+        """Bytes held by decoded frames, including the room kept in free slots"""
+        return self.slots.size()
+
+    def shrink(self):
+        """Gives back the memory kept in free slots, they grow again on their next use"""
+        self.slots.shrink_free()
+
+    def shutdown(self):
+        for process, jobs in self.workers:
+            if process and process.is_alive():
+                process.terminate()
+        self.pending.clear()
+        self.dispatched_at.clear()
+        self.waiting.clear()
+        self.slots.close()
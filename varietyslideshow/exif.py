@@ -0,0 +1,107 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+### BEGIN LICENSE
+# Copyright (c) 2015, Peter Levi <peterlevi@peterlevi.com>
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+import logging
+import queue
+import struct
+import threading
+
+# JPEG markers that start a frame and carry the image size: SOF0-SOF15 except DHT, JPG and DAC
+SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+SOS = 0xDA
+APP1 = 0xE1
+
+JPEG_INTERCHANGE_FORMAT = 0x0201
+JPEG_INTERCHANGE_FORMAT_LENGTH = 0x0202
+
+
+def _thumbnail_from_exif(tiff):
+    """Returns the JPEG thumbnail stored in IFD1 of the TIFF structure of an Exif segment"""
+    order = {b"II": "<", b"MM": ">"}.get(tiff[:2])
+    if order is None:
+        return None
+    ifd0 = struct.unpack_from(order + "I", tiff, 4)[0]
+    count = struct.unpack_from(order + "H", tiff, ifd0)[0]
+    ifd1 = struct.unpack_from(order + "I", tiff, ifd0 + 2 + 12 * count)[0]
+    if not ifd1:
+        return None
+
+    offset = length = None
+    count = struct.unpack_from(order + "H", tiff, ifd1)[0]
+    for i in range(count):
+        tag, _, _, value = struct.unpack_from(order + "HHII", tiff, ifd1 + 2 + 12 * i)
+        if tag == JPEG_INTERCHANGE_FORMAT:
+            offset = value
+        elif tag == JPEG_INTERCHANGE_FORMAT_LENGTH:
+            length = value
+    if not offset or not length or tiff[offset : offset + 2] != b"\xff\xd8":
+        return None
+    return tiff[offset : offset + length]
+
+
+def read_thumbnail(filename):
+    """
+    Returns (thumbnail, (width, height)) for a JPEG with an embedded Exif thumbnail, where
+    thumbnail is the thumbnail's own JPEG data and width and height are those of the full image.
+    Returns None if there is no thumbnail or the file is not a JPEG. Only reads the file's headers.
+    """
+    thumbnail = None
+    try:
+        with open(filename, "rb") as f:
+            if f.read(2) != b"\xff\xd8":
+                return None
+            while True:
+                header = f.read(4)
+                if len(header) < 4 or header[0] != 0xFF or header[1] == SOS:
+                    return None
+                marker, length = header[1], struct.unpack(">H", header[2:])[0]
+                if length < 2:
+                    return None  # broken, and f.read would read the whole file
+                segment = f.read(length - 2)
+                if marker == APP1 and thumbnail is None and segment.startswith(b"Exif\0\0"):
+                    thumbnail = _thumbnail_from_exif(segment[6:])
+                elif marker in SOF_MARKERS:
+                    if thumbnail is None:
+                        return None
+                    height, width = struct.unpack_from(">xHH", segment)
+                    return thumbnail, (width, height)
+    except (OSError, struct.error):
+        return None
+
+
+class ThumbnailReader:
+    """
+    Reads Exif thumbnails in a background thread, so that whoever needs one never waits for the
+    disk. request(filename, callback) has the thread call callback(read_thumbnail(filename)),
+    with None if reading it failed in any way.
+    """
+
+    def __init__(self):
+        self.requests = queue.Queue()
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+
+    def request(self, filename, callback):
+        self.requests.put((filename, callback))
+
+    def _run(self):
+        while True:
+            filename, callback = self.requests.get()
+            try:
+                thumbnail = read_thumbnail(filename)
+            except:
+                logging.exception("Could not read the thumbnail of %s" % filename)
+                thumbnail = None
+            callback(thumbnail)
@@ -0,0 +1,143 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+### BEGIN LICENSE
+# Copyright (c) 2015, Peter Levi <peterlevi@peterlevi.com>
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+import os
+from array import array
+
+ERROR = 1
+DELETED = 2
+
+
+class FileTable:
+    """
+    Compact storage for the paths of a large image library. Every file gets an integer id; its
+    folder is stored once in an interned folder table, its basename in one shared byte buffer,
+    and its size, mtime and state flags in typed arrays indexed by id. Memory use grows with the
+    number of files rather than with the total length of their paths.
+    Ids are never reused: removing a file only flags it as deleted, and adding the same path
+    again revives the old id.
+    """
+
+    def __init__(self):
+        self.folders = []  # folder id -> path
+        self.folder_ids = {}  # path -> folder id
+        self.folder_files = {}  # folder id -> array of the file ids in it
+        self.folder_of = array("I")  # file id -> folder id
+        self.names = bytearray()  # all basenames, back to back
+        self.name_ends = array("Q")  # file id -> end offset of its name in names
+        self.sizes = array("q")
+        self.mtimes = array("d")
+        self.flags = bytearray()  # file id -> ERROR | DELETED bits
+        self.count = 0  # files not deleted
+        self.good = 0  # files neither deleted nor failed
+
+    def __len__(self):
+        return self.count
+
+    def _folder_id(self, folder):
+        folder_id = self.folder_ids.get(folder)
+        if folder_id is None:
+            folder_id = len(self.folders)
+            self.folders.append(folder)
+            self.folder_ids[folder] = folder_id
+            self.folder_files[folder_id] = array("I")
+        return folder_id
+
+    def name(self, file_id):
+        start = self.name_ends[file_id - 1] if file_id else 0
+        return os.fsdecode(bytes(self.names[start : self.name_ends[file_id]]))
+
+    def path(self, file_id):
+        return os.path.join(self.folders[self.folder_of[file_id]], self.name(file_id))
+
+    def find(self, path):
+        """Returns the id of path, including deleted ones, or None if it was never added"""
+        folder, name = os.path.split(path)
+        folder_id = self.folder_ids.get(folder)
+        if folder_id is None:
+            return None
+        for file_id in self.folder_files[folder_id]:
+            if self.name(file_id) == name:
+                return file_id
+        return None
+
+    def add(self, path, size=0, mtime=0.0):
+        """Returns (file_id, is_new); is_new is False for present or revived deleted files"""
+        file_id = self.find(path)
+        if file_id is not None:
+            self.sizes[file_id] = size
+            self.mtimes[file_id] = mtime
+            if self.flags[file_id] & DELETED:
+                self.flags[file_id] = 0
+                self.count += 1
+                self.good += 1
+            return file_id, False
+        return self.append(path, size, mtime), True
+
+    def append(self, path, size=0, mtime=0.0):
+        """
+        Adds a file known not to be in the table yet and returns its id. Unlike add, this does
+        not look for the path first, which takes time in proportion to the files in its folder -
+        for the bulk of a scan, whose paths are all distinct (see scanner.scan).
+        """
+        folder, name = os.path.split(path)
+        folder_id = self._folder_id(folder)
+        file_id = len(self.flags)
+        self.folder_of.append(folder_id)
+        self.folder_files[folder_id].append(file_id)
+        self.names += os.fsencode(name)
+        self.name_ends.append(len(self.names))
+        self.sizes.append(size)
+        self.mtimes.append(mtime)
+        self.flags.append(0)
+        self.count += 1
+        self.good += 1
+        return file_id
+
+    def remove(self, file_id):
+        if not self.flags[file_id] & DELETED:
+            if not self.flags[file_id] & ERROR:
+                self.good -= 1
+            self.flags[file_id] = DELETED
+            self.count -= 1
+
+    def remove_folder(self, folder):
+        """Removes all files in folder and its subfolders, returns their ids"""
+        prefix = folder + os.sep
+        removed = []
+        for folder_id, path in enumerate(self.folders):
+            if path == folder or path.startswith(prefix):
+                for file_id in self.folder_files[folder_id]:
+                    if not self.flags[file_id] & DELETED:
+                        self.remove(file_id)
+                        removed.append(file_id)
+        return removed
+
+    def stat(self, file_id):
+        """(size, mtime) of a file, as they were when it was added"""
+        return self.sizes[file_id], self.mtimes[file_id]
+
+    def is_good(self, file_id):
+        return not self.flags[file_id]
+
+    def mark_error(self, file_id):
+        if not self.flags[file_id]:
+            self.flags[file_id] = ERROR
+            self.good -= 1
+
+    def clear_error(self, file_id):
+        if self.flags[file_id] == ERROR:
+            self.flags[file_id] = 0
+            self.good += 1
@@ -0,0 +1,83 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+### BEGIN LICENSE
+# Copyright (c) 2015, Peter Levi <peterlevi@peterlevi.com>
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+import logging
+
+MB = 1024 * 1024
+
+# Limits are tightened above HIGH of the budget and relaxed again only when even after relaxing
+# usage would stay below LOW of it, so that they don't flip back and forth every check
+HIGH = 0.9
+LOW = 0.75
+
+# the decode resolution is lowered in steps of this factor, down to MIN_RESOLUTION of the stage's
+RESOLUTION_STEP = 0.8
+MIN_RESOLUTION = 0.5
+
+
+def format_usage(usage):
+    return ", ".join("%s %.1f MB" % (name, size / MB) for name, size in usage.items())
+
+
+class MemoryGovernor:
+    """
+    Keeps the memory held by images - decoded frames waiting for their turn and the textures -
+    under a budget of bytes, by adapting how many images are decoded ahead (prefetch) and at
+    what fraction of the stage size they are decoded (resolution). The lookahead goes first, as
+    it costs nothing on screen; the resolution only when we are down to a single image ahead.
+    A budget of 0 means no limit, prefetch and resolution then never change.
+    """
+
+    def __init__(self, budget, max_prefetch):
+        self.budget = budget
+        self.max_prefetch = max_prefetch
+        self.prefetch = max_prefetch
+        self.resolution = 1.0
+
+    def update(self, used, frame_bytes):
+        """
+        Adapts the limits to used bytes, one step at a time. frame_bytes is what a single decoded
+        image takes at the current resolution, to tell whether relaxing would fit the budget.
+        Returns True if the limits were tightened and memory should be given back.
+        """
+        if not self.budget:
+            return False
+
+        if used > HIGH * self.budget:
+            if self.prefetch > 1:
+                self.prefetch -= 1
+            elif self.resolution > MIN_RESOLUTION:
+                self.resolution = max(MIN_RESOLUTION, self.resolution * RESOLUTION_STEP)
+            else:
+                return False
+            logging.warning(
+                "Memory used by images is %.1f MB of the %.1f MB budget, decoding %d images ahead "
+                "at %d%% resolution" % (used / MB, self.budget / MB, self.prefetch, self.percent())
+            )
+            return True
+
+        if self.resolution < 1:
+            # the frames grow with the square of the resolution
+            if used + frame_bytes * (1 / RESOLUTION_STEP**2 - 1) < LOW * self.budget:
+                self.resolution = min(1.0, self.resolution / RESOLUTION_STEP)
+                logging.info("Memory is available again, decoding at %d%%" % self.percent())
+        elif self.prefetch < self.max_prefetch:
+            if used + frame_bytes < LOW * self.budget:
+                self.prefetch += 1
+                logging.info("Memory is available again, decoding %d images ahead" % self.prefetch)
+        return False
+
+    def percent(self):
+        return round(self.resolution * 100)
@@ -0,0 +1,97 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+### BEGIN LICENSE
+# Copyright (c) 2015, Peter Levi <peterlevi@peterlevi.com>
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+import random
+from array import array
+from collections import deque
+
+
+class Playlist:
+    """
+    The order in which files are shown: an array of FileTable ids with a cursor that wraps around,
+    plus a queue of explicitly requested files that take precedence. Files that failed to decode or
+    were deleted are skipped; the table's live count of good files makes "is there anything left to
+    show" O(1). With reshuffle, random order is reshuffled every time the cursor wraps around.
+    """
+
+    def __init__(self, table, sort="random", descending=False, reshuffle=False):
+        self.table = table
+        self.sort = sort
+        self.descending = descending
+        self.reshuffle = reshuffle and sort == "random"
+        self.order = array("I")
+        self.queued = deque()
+        self.cursor = 0
+
+    def add(self, file_ids, shuffle=False):
+        """Appends files, or with shuffle, spreads them randomly over the not yet shown part"""
+        for file_id in file_ids:
+            self.order.append(file_id)
+            if shuffle:
+                i = random.randint(self.cursor, len(self.order) - 1)
+                self.order[i], self.order[-1] = self.order[-1], self.order[i]
+
+    def _sorted_position(self, path):
+        lo, hi = 0, len(self.order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            other = self.table.path(self.order[mid])
+            if (other > path) if self.descending else (other <= path):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def insert(self, file_id):
+        """Inserts a single new file where the sort order would have put it"""
+        if self.sort == "random":
+            i = random.randint(self.cursor, len(self.order))
+        elif self.sort == "name":
+            i = self._sorted_position(self.table.path(file_id))
+        elif self.sort == "date" and self.descending:
+            i = 0  # a new file is the newest one
+        else:
+            i = len(self.order)
+
+        self.order.insert(i, file_id)
+        if i < self.cursor:
+            self.cursor += 1
+
+    def queue(self, file_id):
+        self.queued.append(file_id)
+
+    def requeue(self, file_ids):
+        """Puts files taken with next() back in front, to be returned again in the same order"""
+        self.queued.extendleft(reversed(file_ids))
+
+    def unqueue(self, file_ids):
+        self.queued = deque(f for f in self.queued if f not in file_ids)
+
+    def next(self):
+        """Returns the id of the next file to show, or None if there are no good files"""
+        if self.queued:
+            return self.queued.popleft()
+        if not self.table.good:
+            return None
+
+        while True:
+            file_id = self.order[self.cursor]
+            self.cursor += 1
+            if self.cursor == len(self.order):
+                self.cursor = 0
+                if self.reshuffle:
+                    random.shuffle(self.order)
+            if self.table.is_good(file_id):
+                return file_id
@@ -0,0 +1,71 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+### BEGIN LICENSE
+# Copyright (c) 2015, Peter Levi <peterlevi@peterlevi.com>
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+import logging
+
+# how often pan and zoom are updated in low-power mode, at most and at least - below that slides
+# are shown without motion
+LOW_POWER_FPS = 16
+MIN_FPS = 4
+
+# the fade between static slides in low-power mode, in milliseconds, if --fade is longer
+SHORT_FADE = 400
+
+# frames to judge the frame cost over
+FRAME_WINDOW = 30
+
+
+class FramePacer:
+    """
+    Picks the rate at which pan and zoom are updated in low-power mode, from how much frames
+    cost: the time from moving the textures to the stage having painted them. When the typical
+    frame takes more than half of its time slot the rate is halved, and once it would drop below
+    MIN_FPS, fps becomes 0 - slides are static from then on. When frames are cheap again the
+    rate goes back up, to at most max_fps.
+    """
+
+    def __init__(self, max_fps=LOW_POWER_FPS):
+        self.max_fps = max_fps
+        self.fps = max_fps
+        self.costs = []
+
+    def record(self, cost):
+        """Records the cost of a frame in seconds, returns True if fps changed"""
+        if not self.fps:
+            return False
+        self.costs.append(cost)
+        if len(self.costs) < FRAME_WINDOW:
+            return False
+
+        costs, self.costs = sorted(self.costs), []
+        typical = costs[len(costs) // 2]
+        slot = 1 / self.fps
+        if typical > slot / 2:
+            self.fps = self.fps // 2 if self.fps // 2 >= MIN_FPS else 0
+            if self.fps:
+                logging.warning(
+                    "Frames take %d ms, updating pan and zoom %d times per second"
+                    % (typical * 1000, self.fps)
+                )
+            else:
+                logging.warning("Frames take %d ms, turning off pan and zoom" % (typical * 1000))
+            return True
+        if typical < slot / 8 and self.fps < self.max_fps:
+            self.fps = min(self.max_fps, self.fps * 2)
+            logging.info(
+                "Frames are cheap again, updating pan and zoom %d times per second" % self.fps
+            )
+            return True
+        return False
@@ -0,0 +1,141 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+### BEGIN LICENSE
+# Copyright (c) 2015, Peter Levi <peterlevi@peterlevi.com>
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+import json
+import logging
+import os
+
+IMAGE_TYPES = (".jpg", ".jpeg", ".png", ".bmp")
+
+BATCH_SIZE = 500
+
+
+def is_image_name(name):
+    return name.lower().endswith(IMAGE_TYPES)
+
+
+def list_folder(folder):
+    """
+    Returns (files, subfolders) for a folder, where files is a list of (name, size, mtime)
+    for the images directly in it and subfolders is a list of names
+    """
+    files = []
+    subfolders = []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            # the DirEntry type info comes for free from readdir, only images get stat-ed
+            if entry.is_dir(follow_symlinks=False):
+                subfolders.append(entry.name)
+            elif is_image_name(entry.name) and entry.is_file():
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                files.append((entry.name, st.st_size, st.st_mtime))
+    return files, subfolders
+
+
+class FolderIndex:
+    """
+    Persistent listing of previously scanned folders: their images with sizes and mtimes, their
+    subfolders, and their own mtime. A folder whose mtime has not changed since the last run is
+    not listed again - only folders where files were added, removed or renamed are re-read.
+    Note that a file modified in place does not change its folder's mtime, so sizes and mtimes
+    of such files stay stale until something else in the folder changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.folders = {}  # folder -> [mtime_ns, files, subfolders], as loaded
+        self.scanned = {}  # same, for the folders seen during this scan
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf8") as f:
+                self.folders = json.load(f)["folders"]
+        except FileNotFoundError:
+            pass
+        except:
+            logging.exception("Could not load folder index %s, rescanning" % self.path)
+
+    def save(self, roots):
+        # keep what we know about folders outside this scan, forget the ones that disappeared
+        folders = {
+            folder: listing
+            for folder, listing in self.folders.items()
+            if not any(folder == root or folder.startswith(root + os.sep) for root in roots)
+        }
+        folders.update(self.scanned)
+        try:
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf8") as f:
+                json.dump({"folders": folders}, f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(tmp, self.path)
+        except:
+            logging.exception("Could not save folder index %s" % self.path)
+
+    def list_folder(self, folder):
+        mtime = os.stat(folder).st_mtime_ns
+        listing = self.folders.get(folder)
+        if listing and listing[0] == mtime:
+            files, subfolders = listing[1], listing[2]
+        else:
+            files, subfolders = list_folder(folder)
+        self.scanned[folder] = [mtime, files, subfolders]
+        return files, subfolders
+
+
+def scan(paths, index=None, batch_size=BATCH_SIZE):
+    """
+    Yields lists of (path, size, mtime) for the images found in the given files and folders,
+    a batch at a time, so callers can start using the first images while the rest of the tree
+    is still being listed. If a FolderIndex is given, unchanged folders are served from it.
+    Like os.walk, this does not follow symlinks to folders and silently skips unreadable ones.
+    Every file is yielded once, even when the given paths overlap.
+    """
+    lister = index.list_folder if index else list_folder
+    batch = []
+    paths = [os.path.abspath(os.path.expanduser(path)) for path in paths]
+    files = set(path for path in paths if os.path.isfile(path))
+    seen = set()  # folders listed and given files yielded so far
+    for path in paths:
+        if path in files:
+            if is_image_name(path) and path not in seen:
+                seen.add(path)
+                st = os.stat(path)
+                batch.append((path, st.st_size, st.st_mtime))
+            continue
+
+        folders = [path]
+        while folders:
+            folder = folders.pop()
+            if folder in seen:
+                continue
+            seen.add(folder)
+            try:
+                listing, subfolders = lister(folder)
+            except OSError:
+                continue
+            folders.extend(os.path.join(folder, name) for name in subfolders)
+            for name, size, mtime in listing:
+                filename = os.path.join(folder, name)
+                if filename not in files:  # given explicitly, yielded already or still to come
+                    batch.append((filename, size, mtime))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+
+    if batch:
+        yield batch
@@ -0,0 +1,154 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+### BEGIN LICENSE
+# Copyright (c) 2015, Peter Levi <peterlevi@peterlevi.com>
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+import errno
+import json
+import logging
+import os
+import socket
+import stat
+import time
+from collections import deque
+
+# Per-slide phases, in pipeline order. All are durations in seconds:
+# next_file - picking the file (get_next_file), dispatch - submitting the decode job,
+# decode - decoding and scaling in the worker (or reading it from the cache),
+# transfer - from the worker sending the result to the UI receiving it,
+# wait - how long the slide's turn was extended because it was not decoded yet,
+# upload - uploading the texture, transition - starting the fade and the pan/zoom
+PHASES = ("next_file", "dispatch", "decode", "transfer", "wait", "upload", "transition")
+
+WINDOW = 100
+
+
+class SlideStats:
+    """Per-slide timings over a rolling window of recent slides, plus running counters"""
+
+    def __init__(self, window=WINDOW):
+        self.slides = deque(maxlen=window)
+        self.counters = dict.fromkeys(
+            (
+                "slides",
+                "skipped",
+                "late_slides",
+                "thumbnails",
+                "swapped_slides",
+                "late_uploads",
+                "cache_hits",
+                "worker_restarts",
+            ),
+            0,
+        )
+        self.started = time.monotonic()
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def record(self, timings):
+        self.slides.append(timings)
+        self.count("slides")
+
+    def mean(self, phase):
+        """Mean duration of a phase over the window, None if there is nothing to go by"""
+        values = [slide[phase] for slide in self.slides if phase in slide]
+        return sum(values) / len(values) if values else None
+
+    def summary(self, **gauges):
+        phases = {}
+        for phase in PHASES:
+            values = sorted(slide[phase] for slide in self.slides if phase in slide)
+            if values:
+                phases[phase] = {
+                    "mean_ms": round(sum(values) / len(values) * 1000, 2),
+                    "p95_ms": round(values[int(0.95 * (len(values) - 1))] * 1000, 2),
+                    "max_ms": round(values[-1] * 1000, 2),
+                }
+        return {
+            "time": time.time(),
+            "uptime": round(time.monotonic() - self.started, 1),
+            "window": len(self.slides),
+            "phases": phases,
+            "counters": dict(self.counters),
+            "gauges": gauges,
+        }
+
+
+class StatsWriter:
+    """
+    Writes stats records as JSON lines, either appended to a file, or - for a target like
+    unix:/path/to/socket - to every client connected to a UNIX socket we listen on.
+    The socket side never blocks: clients that don't keep up are dropped.
+    """
+
+    def __init__(self, target):
+        self.file = None
+        self.server = None
+        self.clients = []
+        if target.startswith("unix:"):
+            self.path = target[len("unix:") :]
+            try:
+                mode = os.lstat(self.path).st_mode
+            except FileNotFoundError:
+                mode = None
+            if mode is not None:
+                # only a socket left behind by an earlier run, never a file given by mistake
+                if not stat.S_ISSOCK(mode):
+                    raise FileExistsError(errno.EEXIST, "Exists and is not a socket", self.path)
+                os.remove(self.path)
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server.bind(self.path)
+            self.server.listen(5)
+            self.server.setblocking(False)
+        else:
+            self.file = open(target, "a", encoding="utf8")
+
+    def fileno(self):
+        """The listening socket's fd, to watch for new clients, or None when writing to a file"""
+        return self.server.fileno() if self.server else None
+
+    def accept(self):
+        try:
+            client, _ = self.server.accept()
+            client.setblocking(False)
+            self.clients.append(client)
+        except OSError:
+            pass
+
+    def write(self, record):
+        line = json.dumps(record) + "\n"
+        if self.file:
+            try:
+                self.file.write(line)
+                self.file.flush()
+            except OSError:
+                logging.exception("Could not write stats:")
+        for client in list(self.clients):
+            try:
+                client.sendall(line.encode("utf8"))
+            except OSError:
+                client.close()
+                self.clients.remove(client)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+        if self.server:
+            for client in self.clients:
+                client.close()
+            self.server.close()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
@@ -16,49 +16,984 @@
 ### END LICENSE
 import json
 import logging
+import math
 import optparse
 import os
 import random
 import signal
 import sys
+import threading
 import time
-from multiprocessing import Process, Queue
+from collections import deque, namedtuple
+from functools import partial
 
 from .AttrDict import AttrDict
+from .badfiles import BadFiles
+from .cache import ScaledImageCache
+from .decoding import DECODERS, INVALID, DecodePool, slot_bytes
+from .exif import ThumbnailReader
+from .filetable import FileTable
+from .memory import MB, MemoryGovernor, format_usage
+from .playlist import Playlist
+from .power import LOW_POWER_FPS, SHORT_FADE, FramePacer
+from .scanner import IMAGE_TYPES, FolderIndex, scan
+from .stats import SlideStats, StatsWriter
 
 # fmt: off
 import gi  # isort:skip
 gi.require_version('Gtk', '3.0')
+gi.require_version('Gdk', '3.0')
 gi.require_version('GtkClutter', '1.0')
-from gi.repository import GtkClutter  # isort:skip
-
-GtkClutter.init(sys.argv)
-
-from gi.repository import Gtk, Gdk, GObject, Clutter, GLib, GdkPixbuf, Cogl  # isort:skip
-
-Gtk.init(sys.argv)
+gi.require_version('GdkPixbuf', '2.0')
+from gi.repository import Gio, GObject, GLib, GdkPixbuf  # isort:skip
 # fmt: on
 
+# Set by init_display and init_toolkit. The toolkit is initialized on first use rather than on
+# import: --help only needs the display, and the first image decodes while Clutter starts up.
+Gdk = Gtk = Clutter = GtkClutter = None
+
+STARTED_AT = time.monotonic()
 
-IMAGE_TYPES = (".jpg", ".jpeg", ".png", ".bmp")
 
 SECONDS = 6
 FADE = 0.5
 ZOOM = 0.2
 PAN = 0.05
+WORKERS = 2
+PREFETCH = 2
+CACHE_SIZE = 200
+DECODER = "auto"
+
+STATS_INTERVAL = 10
+MEMORY_CHECK_INTERVAL = 5
+MEMORY_LOG_INTERVAL = 60
+
+# the texture on screen, the one fading out, and the one the next image gets uploaded to
+TEXTURE_POOL_SIZE = 3
+
+# how many of the last shown images are kept decoded, to go back to them without decoding again
+HISTORY = 5
+
+NEXT_KEYS = ("Right", "Page_Down")
+BACK_KEYS = ("Left", "Page_Up", "BackSpace")
+PAUSE_KEYS = ("space", "Pause")
+
+# how long the stage size has to stay the same before prefetched images are decoded again for it
+RESIZE_DELAY = 300
+
+# A slide's pan and zoom, chosen when it is queued for decoding so that it is decoded at the size
+# it will actually reach on screen. pan_x and pan_y are in units of the --pan distance.
+Motion = namedtuple("Motion", "enlarge zoom_factor pan_x pan_y")
 
 random.seed(time.time())
 logging.basicConfig()
 
 
+def init_display():
+    """Connects to the display, returns the default screen or None if there is no display"""
+    global Gdk
+    from gi.repository import Gdk
+
+    Gdk.init_check(sys.argv)
+    return Gdk.Screen.get_default()
+
+
+def init_toolkit():
+    global Gtk, Clutter, GtkClutter
+    from gi.repository import GtkClutter
+
+    GtkClutter.init(sys.argv)
+    from gi.repository import Gtk, Clutter
+
+    Gtk.init(sys.argv)
+
+
 def is_image(filename):
     return os.path.isfile(filename) and filename.lower().endswith(IMAGE_TYPES)
 
 
+class PendingSlide:
+    """An upcoming image in the prefetch pipeline, decoding or already decoded"""
+
+    def __init__(self, file_id, filename, job_id, motion, cover):
+        self.file_id = file_id
+        self.filename = filename
+        self.job_id = job_id
+        self.motion = motion
+        self.cover = cover  # the size the image is decoded to cover, see decode_box
+        self.frame = None  # until uploaded, after that its slot is given back
+        self.pixels = None  # (pixels, has_alpha, width, height, rowstride, bpp) once uploaded
+        self.texture = None  # set once uploaded ahead of its turn, see stage_next_slide
+        self.thumbnail = None  # read_thumbnail's result once read, False if there is none
+        self.thumbnail_tried = False  # see stage_thumbnail
+        self.target = None  # (size, position) for start_pan_and_zoom
+        self.layout = None  # (stage size, image size) that target is for, see lay_out
+        self.timings = {}  # phase -> seconds, see stats.PHASES
+
+    @property
+    def ready(self):
+        return self.frame is not None or self.pixels is not None
+
+
+class SlideshowWindow:
+    """
+    The slideshow on one monitor: its window and stage, its own order of images and timing, and
+    the prefetch pipeline feeding it. All windows share the VarietySlideshow's file table, decode
+    workers, scaled image cache and stats.
+    """
+
+    def __init__(self, app, monitor, monitor_size):
+        self.app = app
+        self.monitor = monitor
+        self.monitor_size = monitor_size
+
+        # shared by all windows
+        self.options = app.options
+        self.interval = app.interval
+        self.fade_time = app.fade_time
+        self.files = app.files
+        self.decode_pool = app.decode_pool
+        self.stats = app.stats
+        self.governor = app.governor
+
+        self.playlist = Playlist(
+            self.files,
+            self.options.sort.lower(),
+            descending=self.options.sort_order.lower().startswith("desc"),
+            reshuffle=self.options.reshuffle,
+        )
+        self.started = False
+        self.pipeline = deque()  # PendingSlides, in display order
+        self.pending_slides = {}  # job_id -> PendingSlide
+        self.waiting_for_slide = False
+        self.staged_slide = None  # uploaded to its texture, waiting for its turn
+        self.staging_scheduled = False
+        self.waiting_since = None
+        self.next_due = None  # time.monotonic() of the next transition, while one is scheduled
+        self.paused = False
+        self.history = []  # the last shown slides that still have their pixels, oldest first
+        self.will_enlarge = random.choice((True, False))
+        self.stage_size = None  # what upcoming slides are decoded for, the monitor's until started
+        self.resize_timeout = None
+        self.texture = None  # on screen, one of self.textures once created
+        self.current_slide = None  # the PendingSlide shown on self.texture
+        self.next_texture = None
+        self.prev_texture = None
+        self.texture_formats = {}  # texture -> (width, height, has_alpha) of its current pixels
+
+        # low-power mode, see start_pan_and_zoom
+        self.pacer = FramePacer() if self.options.low_power else None
+        # texture -> (size, position, target size, target position, start, duration)
+        self.animations = {}
+        self.motion_tick = None
+        self.tick_at = None  # when textures were last moved, until that gets painted
+
+    def get_next_file(self):
+        """Returns the id of the next file in the FileTable, or None"""
+        if not self.app.running:
+            return None
+        file_id = self.playlist.next()
+        if file_id is None and self.app.scan_done and len(self.files):
+            logging.error("Could not find any non-corrupt images, exiting.")
+            self.app.quit()
+        return file_id
+
+    def queue(self, filename):
+        file_id, _ = self.files.add(filename)
+        self.playlist.queue(file_id)
+
+    def evict(self, removed):
+        """Drops the given file ids from the playlist queue and from the upcoming slides"""
+        # the playlist skips deleted ids, but explicitly queued ones would still be shown
+        self.playlist.unqueue(removed)
+
+        # evict the removed files from pending decodes, their results will be dropped on arrival
+        if self.staged_slide and self.staged_slide.file_id in removed:
+            self.staged_slide = None  # its texture simply goes back to the pool
+        for slide in [slide for slide in self.pipeline if slide.file_id in removed]:
+            self.drop(slide)
+        self.history = [slide for slide in self.history if slide.file_id not in removed]
+        if self.started:
+            self.prepare_next_data()
+
+    def drop(self, slide):
+        """
+        Removes an upcoming slide. Its decode is cancelled if it has not started yet, otherwise
+        its result is released on arrival.
+        """
+        self.pipeline.remove(slide)
+        if self.pending_slides.pop(slide.job_id, None):
+            self.decode_pool.cancel(slide.job_id)
+        if slide.frame:
+            self.decode_pool.release(slide.frame)
+
+    def trim_pipeline(self, decoding_only=False):
+        """
+        Drops the upcoming slides beyond the current prefetch, their files go back in front.
+        With decoding_only, only those not decoded yet: this cancels decodes that won't be
+        needed for a while after going back in history.
+        """
+        surplus = list(self.pipeline)[self.governor.prefetch :]
+        if decoding_only:
+            surplus = [slide for slide in surplus if not slide.ready]
+        for slide in surplus:
+            self.drop(slide)
+        self.playlist.requeue([slide.file_id for slide in surplus])
+
+    def remember(self, slide):
+        """Keeps a slide that is leaving the screen in history, see go_back"""
+        if slide.pixels is not None:
+            self.history.append(slide)
+            del self.history[:-HISTORY]
+
+    def reuse(self, slide):
+        """Puts a slide that was on the screen, or on its way to it, back in the pipeline's front"""
+        slide.texture = None
+        slide.target = None
+        slide.layout = None
+        slide.timings = {}
+        slide.thumbnail_tried = True
+        if slide.ready or slide.job_id in self.pending_slides:
+            self.pipeline.appendleft(slide)
+        else:
+            self.playlist.requeue([slide.file_id])  # shown with its thumbnail only
+
+    def go_back(self):
+        """Shows the previous slide from history, the current one is shown again next"""
+        if not self.started or not self.history or self.current_slide is None:
+            return
+        if self.staged_slide:
+            self.reuse(self.staged_slide)
+            self.staged_slide = None
+        self.reuse(self.current_slide)
+        self.reuse(self.history.pop())
+        self.trim_pipeline(decoding_only=True)
+        self.go_next(navigation="back")
+
+    def toggle_pause(self):
+        self.paused = not self.paused
+        if hasattr(self, "next_timeout"):
+            GObject.source_remove(self.next_timeout)
+            delattr(self, "next_timeout")
+        self.waiting_for_slide = False
+        self.next_due = None
+        if not self.paused:
+            self.schedule_next()
+        self.update_deadlines()
+
+    def schedule_next(self):
+        self.next_due = time.monotonic() + self.interval / 1000
+        self.next_timeout = GObject.timeout_add(
+            int(self.interval), self.go_next, priority=GLib.PRIORITY_HIGH
+        )
+
+    def deadline(self, position):
+        """When the upcoming slide at position in the pipeline is due on screen"""
+        # when the next transition is not scheduled, the slideshow is starting, paused, or
+        # waiting for the next slide: it is needed right away
+        due = self.next_due or time.monotonic()
+        if self.staged_slide:
+            position += 1
+        return due + position * self.interval / 1000
+
+    def update_deadlines(self):
+        for position, slide in enumerate(self.pipeline):
+            if slide.job_id in self.pending_slides:
+                self.decode_pool.set_deadline(slide.job_id, self.deadline(position))
+
+    def will_be_late(self, slide):
+        """Whether the slide's decode is predicted to finish after its turn"""
+        expected = self.stats.mean("decode") or 0
+        started_at = self.decode_pool.started_at(slide.job_id)
+        return (started_at or time.monotonic()) + expected > self.deadline(0)
+
+    def swap_in_ready(self):
+        """
+        When the next slide won't be decoded in time, brings forward the first upcoming slide
+        that is, so the interval is kept - the late one is shown right after it. Only with random
+        order, sorted ones are kept as they are. Returns whether it swapped.
+        """
+        if self.playlist.sort != "random":
+            return False
+        ready = [slide for slide in self.pipeline if slide.ready]
+        if not ready or ready[0] is self.pipeline[0]:
+            return False
+        self.pipeline.remove(ready[0])
+        self.pipeline.appendleft(ready[0])
+        self.update_deadlines()
+        self.stats.count("swapped_slides")
+        logging.info("Next image will be late, showing %s before it" % ready[0].filename)
+        return True
+
+    def connect_signals(self):
+        # Connect signals
+        def on_button_press(*args):
+            if self.current_mode == "fullscreen" and not self.mode_was_changed:
+                self.app.quit()
+
+        def on_motion(*args):
+            if (
+                self.options.quit_on_motion
+                and self.current_mode == "fullscreen"
+                and not self.mode_was_changed
+            ):
+                self.app.quit()
+
+        def on_key_press(widget, event):
+            key = Gdk.keyval_name(event.keyval)
+
+            if key in NEXT_KEYS:
+                self.go_next(navigation="next")
+                return
+            elif key in BACK_KEYS:
+                self.go_back()
+                return
+            elif key in PAUSE_KEYS:
+                self.toggle_pause()
+                return
+
+            if self.current_mode == "fullscreen" and not self.mode_was_changed:
+                self.app.quit()
+                return
+
+            if key == "Escape":
+                self.app.quit()
+
+            elif key in ("f", "F", "F11"):
+                if self.current_mode == "desktop":
+                    return
+                if self.current_mode == "fullscreen":
+                    self.current_mode = "window"
+                    self.window.unfullscreen()
+                else:
+                    self.current_mode = "fullscreen"
+                    self.window.fullscreen()
+                self.mode_was_changed = True
+                GObject.timeout_add(200, self.go_next)
+
+            elif key in ("d", "D"):
+                if self.current_mode == "undecorated":
+                    self.current_mode = "window"
+                    self.window.set_decorated(True)
+                else:
+                    self.current_mode = "undecorated"
+                    self.window.set_decorated(False)
+
+        self.window.connect("delete-event", self.app.quit)
+        self.stage.connect("destroy", self.app.quit)
+        self.stage.connect("key-press-event", on_key_press)
+        self.stage.connect("button-press-event", on_button_press)
+        self.stage.connect("motion-event", on_motion)
+        self.stage.connect("allocation-changed", self.on_stage_resized)
+        if self.pacer:
+            self.stage.connect("after-paint", self.on_after_paint)
+
+    def create(self):
+        """Creates the window and its stage, once the toolkit is initialized"""
+        self.window = Gtk.Window()
+        self.window.set_title(self.options.title)
+        self.screen = self.window.get_screen()
+
+        self.embed = GtkClutter.Embed()
+        self.window.add(self.embed)
+        self.embed.set_visible(True)
+
+        self.stage = self.embed.get_stage()
+        self.stage.set_color(Clutter.Color.get_static(Clutter.StaticColor.BLACK))
+        if self.options.mode == "fullscreen":
+            self.stage.hide_cursor()
+
+        self.textures = [self.create_texture() for _ in range(TEXTURE_POOL_SIZE)]
+        for texture in self.textures:
+            self.stage.add_actor(texture)
+        self.texture = self.textures[0]
+
+        self.connect_signals()
+
+        self.window.resize(600, 400)
+        self.move_to_monitor()
+
+        self.current_mode = self.options.mode
+        self.mode_was_changed = False
+        if self.options.mode == "fullscreen":
+            self.window.fullscreen()
+            self.window.set_skip_taskbar_hint(True)
+        elif self.options.mode == "maximized":
+            self.window.maximize()
+        elif self.options.mode == "desktop":
+            self.window.maximize()
+            self.window.set_decorated(False)
+            self.window.set_keep_below(True)
+
+            # ensure window will get deiconified (i.e. unminimized) after "Show Desktop" button/shortcut
+            def _window_state_changed(window, event, *args):
+                if event.new_window_state & Gdk.WindowState.ICONIFIED:
+                    self.window.deiconify()
+                    self.window.present()
+
+            self.window.connect("window-state-event", _window_state_changed)
+
+        elif self.options.mode == "undecorated":
+            self.window.set_decorated(False)
+
+        if self.options.hide_from_taskbar:
+            self.window.set_skip_taskbar_hint(True)
+
+        # Start once the window has its final size, as the first slide is laid out for it. Modes
+        # that change the size are reported with a window-state-event, the timeout is for window
+        # managers that don't (or for no window manager at all).
+        final_state = {
+            "fullscreen": Gdk.WindowState.FULLSCREEN,
+            "maximized": Gdk.WindowState.MAXIMIZED,
+            "desktop": Gdk.WindowState.MAXIMIZED,
+        }.get(self.options.mode)
+
+        def on_window_state(window, event):
+            if final_state and event.new_window_state & final_state:
+                GLib.idle_add(self.start, priority=GLib.PRIORITY_LOW)
+
+        def after_show(*args):
+            if final_state:
+                GObject.timeout_add(200, self.start)
+            else:
+                GLib.idle_add(self.start, priority=GLib.PRIORITY_LOW)
+
+        self.window.connect("window-state-event", on_window_state)
+        self.window.connect("show", after_show)
+
+    def show(self):
+        self.window.show()
+
+    def start(self):
+        if self.started or not self.app.running:
+            return False
+        self.move_to_monitor()
+        self.started = True
+        self.stage_size = self.stage.get_width(), self.stage.get_height()
+        self.retarget()
+        self.prepare_next_data()
+        self.go_next()
+        return False
+
+    def move_to_monitor(self):
+        rect = self.app.monitor_geometry(self.screen, self.monitor)
+        self.window.move(
+            rect.x + (rect.width - self.window.get_size()[0]) / 2,
+            rect.y + (rect.height - self.window.get_size()[1]) / 2,
+        )
+
+    def go_next(self, *args, navigation=None):
+        """
+        Shows the next slide. navigation is "next" or "back" when the user asked for it, and then
+        the slide is not counted in the stats. With "back" the current slide is not put in
+        history, as go_back has put it in front of the pipeline.
+        """
+        if not self.app.running or not self.started:
+            return
+        try:
+            if hasattr(self, "next_timeout"):
+                GObject.source_remove(self.next_timeout)
+                delattr(self, "next_timeout")
+            self.next_due = None
+
+            if (
+                not self.staged_slide
+                and not (self.pipeline and self.pipeline[0].ready)
+                and not self.swap_in_ready()
+                and not self.stage_thumbnail()
+            ):
+                # Next image is not decoded yet and has no thumbnail - keep showing the current one
+                # and go on as soon as the next one arrives (see on_decoded)
+                if not self.waiting_for_slide:
+                    logging.info("Next image is not ready yet, extending the current one")
+                    if not navigation:
+                        self.stats.count("late_slides")
+                    self.waiting_since = time.monotonic()
+                self.waiting_for_slide = True
+                self.prepare_next_data()
+                self.update_deadlines()
+                return
+
+            wait = time.monotonic() - self.waiting_since if self.waiting_for_slide else 0
+            self.waiting_for_slide = False
+            if not self.staged_slide:
+                # the upload did not make it before its deadline, so it happens on the critical path
+                self.stage_next_slide()
+                if not navigation:
+                    self.stats.count("late_uploads")
+                    logging.info(
+                        "Texture upload was late, did it on transition start (%d ms)"
+                        % (self.staged_slide.timings["upload"] * 1000)
+                    )
+
+            start = time.monotonic()
+            slide, self.staged_slide = self.staged_slide, None
+            if slide.layout[0] != (self.stage.get_width(), self.stage.get_height()):
+                # staged before the stage was resized, e.g. right after going fullscreen
+                self.lay_out(slide, slide.layout[1])
+            self.next_texture = slide.texture
+            self.toggle(self.texture, False)
+            self.toggle(self.next_texture, True)
+
+            self.start_pan_and_zoom(self.next_texture, *slide.target)
+            if self.current_slide and navigation != "back":
+                self.remember(self.current_slide)
+            self.current_slide = slide
+            slide.timings["wait"] = wait
+            slide.timings["transition"] = time.monotonic() - start
+            if not navigation:
+                self.stats.record(slide.timings)
+            if not self.app.first_image_shown:
+                self.app.first_image_shown = True
+                self.app.startup_time = time.monotonic() - STARTED_AT
+                logging.info("First image shown %d ms after start" % (self.app.startup_time * 1000))
+
+            self.prev_texture = self.texture
+            self.texture = self.next_texture
+
+            if not self.paused:
+                self.schedule_next()
+            self.prepare_next_data()
+            self.update_deadlines()
+            self.schedule_staging()
+        except:
+            logging.exception("Oops, exception in next, rescheduling:")
+            self.next_timeout = GObject.timeout_add(100, self.go_next, priority=GLib.PRIORITY_HIGH)
+
+    def schedule_staging(self):
+        """Uploads the next slide's texture when the main loop is idle, ahead of its transition"""
+        if (
+            self.started
+            and not self.staged_slide
+            and self.pipeline
+            and not self.pipeline[0].ready
+            and self.will_be_late(self.pipeline[0])
+        ):
+            self.swap_in_ready()
+        if (
+            self.started
+            and not self.staged_slide
+            and not self.staging_scheduled
+            and self.pipeline
+            and self.pipeline[0].ready
+        ):
+            self.staging_scheduled = True
+            GLib.idle_add(self.on_staging_idle, priority=GLib.PRIORITY_LOW)
+
+    def on_staging_idle(self):
+        self.staging_scheduled = False
+        if self.app.running and not self.staged_slide and self.pipeline and self.pipeline[0].ready:
+            self.stage_next_slide()
+        return False
+
+    def stage_next_slide(self):
+        start = time.monotonic()
+        slide = self.pipeline.popleft()
+        slide.texture = self.free_texture()
+        if slide.frame:
+            slide.pixels = self.upload(slide.texture, slide.frame)
+            slide.frame = None
+        else:
+            self.upload_pixels(slide.texture, *slide.pixels)  # from history, see go_back
+        self.lay_out(slide)
+        slide.timings["upload"] = time.monotonic() - start
+        self.staged_slide = slide
+
+    def stage_thumbnail(self):
+        """
+        Stages the next slide with the Exif thumbnail of its image, when its decode is late.
+        The slide's pan and zoom are set up for the full image, which is swapped into the same
+        texture when it arrives (see on_decoded), so the animation goes on undisturbed.
+        """
+        if not self.pipeline or self.pipeline[0].thumbnail_tried or not self.pipeline[0].thumbnail:
+            return False  # the thumbnail is read in the background, see on_thumbnail_read
+        start = time.monotonic()
+        slide = self.pipeline[0]
+        slide.thumbnail_tried = True
+        (data, image_size), slide.thumbnail = slide.thumbnail, False
+        try:
+            loader = GdkPixbuf.PixbufLoader.new_with_type("jpeg")
+            loader.write(data)
+            loader.close()
+        except GLib.Error:
+            return False
+        pixbuf = loader.get_pixbuf()
+
+        # the slide is on its way to the screen now, on_decoded finds it in pending_slides
+        self.pipeline.popleft()
+        slide.texture = self.free_texture()
+        self.upload_pixels(
+            slide.texture,
+            pixbuf.get_pixels(),
+            pixbuf.get_has_alpha(),
+            pixbuf.get_width(),
+            pixbuf.get_height(),
+            pixbuf.get_rowstride(),
+            4 if pixbuf.get_has_alpha() else 3,
+        )
+        self.lay_out(slide, image_size)
+        slide.timings["upload"] = time.monotonic() - start
+        self.staged_slide = slide
+        self.stats.count("thumbnails")
+        logging.info("Next image is not ready yet, showing its thumbnail")
+        return True
+
+    def on_thumbnail_read(self, slide, thumbnail):
+        slide.thumbnail = thumbnail or False
+        if (
+            self.app.running
+            and self.waiting_for_slide
+            and self.pipeline
+            and self.pipeline[0] is slide
+            and thumbnail
+        ):
+            self.go_next()  # it was waiting for this slide's decode, its thumbnail will do
+        return False
+
+    def get_ratio_to_screen(self, width, height):
+        return max(self.stage.get_width() / width, self.stage.get_height() / height)
+
+    def choose_motion(self):
+        self.will_enlarge = not self.will_enlarge
+        rand_pan = lambda: random.choice((-1, 1)) * (1 + random.random())
+        zoom_factor = (1 + self.options.zoom) * (1 + self.options.zoom * random.random())
+        return Motion(self.will_enlarge, zoom_factor, rand_pan(), rand_pan())
+
+    def safety_zoom(self):
+        return 1 + self.options.pan / 2 if self.options.zoom > 0 else 1
+
+    def decode_box(self, motion):
+        """
+        The size an image has to cover to be sharp at its biggest during the slide: the stage
+        times the slide's zoom. Rounded up to a tenth of the stage size, so that the scaled image
+        cache still gets hits from slides with slightly different zooms. Lowered when memory is
+        short, see MemoryGovernor.
+        """
+        width, height = self.stage_size or self.monitor_size
+        zoom = math.ceil(self.safety_zoom() * motion.zoom_factor * 10) / 10
+        zoom *= self.governor.resolution
+        return int(width * zoom), int(height * zoom)
+
+    def frame_bytes(self):
+        """The most memory a single decoded image of this window can take"""
+        motion = Motion(False, (1 + self.options.zoom) ** 2, 0, 0)
+        return slot_bytes(*self.decode_box(motion))
+
+    def history_bytes(self):
+        """Memory of the pixels kept to show slides again without decoding, see go_back"""
+        slides = set(self.history) | set(self.pipeline) | {self.staged_slide, self.current_slide}
+        return sum(len(slide.pixels[0]) for slide in slides if slide and slide.pixels)
+
+    def texture_bytes(self):
+        """Memory of the pixels in the textures, as uploaded - most drivers pad RGB to RGBA"""
+        return sum(width * height * 4 for width, height, _ in self.texture_formats.values())
+
+    def on_stage_resized(self, *args):
+        if self.resize_timeout:
+            GLib.source_remove(self.resize_timeout)
+        self.resize_timeout = GLib.timeout_add(RESIZE_DELAY, self.on_resize_settled)
+
+    def on_resize_settled(self):
+        self.resize_timeout = None
+        size = self.stage.get_width(), self.stage.get_height()
+        if self.started and self.app.running and size != self.stage_size:
+            self.stage_size = size
+            self.retarget()
+            self.prepare_next_data()
+        return False
+
+    def is_stale(self, slide):
+        """Too small for the stage means blurry, a lot bigger wastes memory and upload time"""
+        needed = self.decode_box(slide.motion)
+        return any(have < need or have > 1.5 * need for have, need in zip(slide.cover, needed))
+
+    def retarget(self):
+        """
+        Upcoming slides decoded (or decoding) for another stage size would be too big or blurry:
+        drops them and puts their files back in front of the playlist to be decoded again.
+        The already uploaded next slide is only laid out again.
+        """
+        if self.staged_slide:
+            self.lay_out(self.staged_slide, self.staged_slide.layout[1])
+        stale = [slide for slide in self.pipeline if self.is_stale(slide)]
+        for slide in stale:
+            self.drop(slide)
+        if stale:
+            logging.info("Stage size changed, decoding %d upcoming images again" % len(stale))
+            self.playlist.requeue([slide.file_id for slide in stale])
+
+    def prepare_next_data(self):
+        """
+        Tops up the pipeline with upcoming files until --prefetch of them are in flight, or less
+        when memory is short (see MemoryGovernor)
+        """
+        while len(self.pipeline) < self.governor.prefetch and self.decode_pool.can_submit():
+            start = time.monotonic()
+            file_id = self.get_next_file()
+            if file_id is None:
+                return
+            filename = self.files.path(file_id)
+            picked = time.monotonic()
+            motion = self.choose_motion()
+            cover = self.decode_box(motion)
+            job_id = self.decode_pool.submit(filename, *cover, self.deadline(len(self.pipeline)))
+            slide = PendingSlide(file_id, filename, job_id, motion, cover)
+            slide.timings["next_file"] = picked - start
+            slide.timings["dispatch"] = time.monotonic() - picked
+            self.pipeline.append(slide)
+            self.pending_slides[job_id] = slide
+            # in case the decode is late, see stage_thumbnail
+            self.app.thumbnails.request(
+                filename, partial(GLib.idle_add, self.on_thumbnail_read, slide)
+            )
+
+    def on_decoded(self, job_id, filename, frame, failure):
+        slide = self.pending_slides.pop(job_id, None)
+        if slide is None:
+            if frame:
+                self.decode_pool.release(frame)
+            return
+
+        if frame:
+            self.app.bad_files.discard(filename)  # in case it was fixed since it failed
+
+        if slide.texture is not None:
+            # shown with its thumbnail - swap in the full image if the slide is still on screen
+            if frame and slide is self.current_slide:
+                slide.pixels = self.upload(slide.texture, frame)
+            elif frame:
+                self.decode_pool.release(frame)
+            else:
+                self.mark_bad(slide, failure)
+            self.prepare_next_data()
+            return
+
+        if frame is None:
+            logging.info("Error in %s, skipping it" % filename)
+            self.stats.count("skipped")
+            self.mark_bad(slide, failure)
+            self.pipeline.remove(slide)
+            self.prepare_next_data()
+        else:
+            slide.frame = frame
+            slide.timings["decode"] = frame.decode_time
+            slide.timings["transfer"] = time.monotonic() - frame.sent_at
+            if frame.cached:
+                self.stats.count("cache_hits")
+
+        if self.waiting_for_slide and self.pipeline and self.pipeline[0].ready:
+            self.go_next()
+        else:
+            self.schedule_staging()
+
+    def mark_bad(self, slide, failure):
+        """
+        Skips a file that could not be decoded for the rest of this run, and in the next ones too
+        if the file itself is bad. Read errors and worker crashes may not happen next time.
+        """
+        self.files.mark_error(slide.file_id)
+        if failure == INVALID:
+            # the file table's stat may be from the folder index, older than what was decoded
+            try:
+                st = os.stat(slide.filename)
+            except OSError:
+                return
+            self.app.bad_files.add(slide.filename, st.st_size, st.st_mtime)
+
+    def create_texture(self):
+        texture = Clutter.Texture.new()
+        texture.set_opacity(0)
+        texture.set_keep_aspect_ratio(True)
+        return texture
+
+    def free_texture(self):
+        """Returns the pooled texture that is neither on screen nor fading out"""
+        for texture in self.textures:
+            if texture is not self.texture and texture is not self.prev_texture:
+                texture.remove_all_transitions()
+                self.animations.pop(texture, None)
+                return texture
+
+    def upload(self, texture, frame):
+        """Uploads a decoded frame and gives back its slot, returns the pixels to keep"""
+        image = (
+            self.decode_pool.pixels(frame),
+            frame.has_alpha,
+            frame.width,
+            frame.height,
+            frame.rowstride,
+            frame.bpp,
+        )
+        self.decode_pool.release(frame)
+        self.upload_pixels(texture, *image)
+        return image
+
+    def upload_pixels(self, texture, pixels, has_alpha, width, height, rowstride, bpp):
+        texture_format = (width, height, has_alpha)
+        if self.texture_formats.get(texture) == texture_format:
+            # same size and format - overwrite the existing GPU texture instead of replacing it
+            texture.set_area_from_rgb_data(
+                pixels,
+                has_alpha,
+                0,
+                0,
+                width,
+                height,
+                rowstride,
+                bpp,
+                Clutter.TextureFlags.NONE,
+            )
+        else:
+            texture.set_from_rgb_data(
+                pixels,
+                has_alpha,
+                width,
+                height,
+                rowstride,
+                bpp,
+                Clutter.TextureFlags.NONE,
+            )
+            self.texture_formats[texture] = texture_format
+
+    def lay_out(self, slide, image_size=None):
+        """Lays the slide's texture out for the current stage size, see initialize_pan_and_zoom"""
+        slide.layout = (self.stage.get_width(), self.stage.get_height()), image_size
+        slide.target = self.initialize_pan_and_zoom(slide.texture, slide.motion, image_size)
+
+    def initialize_pan_and_zoom(self, texture, motion, image_size=None):
+        """
+        Lays texture out for the start of the given Motion, for an image of image_size, by default
+        the size of its contents. Returns the (size, position) to animate to.
+        """
+        pan_px = max(self.stage.get_width(), self.stage.get_height()) * self.options.pan
+        zoom_factor = motion.zoom_factor
+
+        width, height = image_size or texture.get_base_size()
+        scale = self.get_ratio_to_screen(width, height)
+        base_w, base_h = width * scale, height * scale
+
+        safety_zoom = self.safety_zoom()
+
+        small_size = base_w * safety_zoom, base_h * safety_zoom
+        big_size = base_w * safety_zoom * zoom_factor, base_h * safety_zoom * zoom_factor
+        small_position = (
+            -(small_size[0] - self.stage.get_width()) / 2,
+            -(small_size[1] - self.stage.get_height()) / 2,
+        )
+        big_position = (
+            -(big_size[0] - self.stage.get_width()) / 2 + motion.pan_x * pan_px,
+            -(big_size[1] - self.stage.get_height()) / 2 + motion.pan_y * pan_px,
+        )
+
+        if motion.enlarge:
+            initial_size, initial_position = small_size, small_position
+            target_size, target_position = big_size, big_position
+        else:
+            initial_size, initial_position = big_size, big_position
+            target_size, target_position = small_size, small_position
+
+        # set initial size
+        texture.set_size(*initial_size)
+        texture.set_position(*initial_position)
+
+        return target_size, target_position
+
+    def motion_mode(self):
+        """
+        smooth - Clutter animates pan and zoom at the display's refresh rate;
+        stepped - in low-power mode, we move the textures a few times per second (see FramePacer);
+        static - no pan and zoom, nothing gets redrawn between transitions
+        """
+        if self.options.zoom == 0 and self.options.pan == 0:
+            return "static"
+        if not self.pacer:
+            return "smooth"
+        return "stepped" if self.pacer.fps else "static"
+
+    def start_pan_and_zoom(self, texture, target_size, target_position):
+        mode = self.motion_mode()
+        if mode == "static":
+            # stay with the smaller of the two layouts, that shows more of the image
+            if target_size[0] < texture.get_width():
+                texture.set_size(*target_size)
+                texture.set_position(*target_position)
+            return
+        if mode == "stepped":
+            self.animations[texture] = (
+                texture.get_size(),
+                texture.get_position(),
+                target_size,
+                target_position,
+                time.monotonic(),
+                (self.interval + self.fade_time) / 1000,
+            )
+            if not self.motion_tick:
+                self.start_motion_ticks()
+            return
+
+        # start animating to target size
+        texture.save_easing_state()
+        texture.set_easing_mode(Clutter.AnimationMode.LINEAR)
+        texture.set_easing_duration(self.interval + self.fade_time)
+        texture.set_size(*target_size)
+        texture.set_position(*target_position)
+        texture.restore_easing_state()
+
+    def start_motion_ticks(self):
+        self.motion_tick = GLib.timeout_add(int(1000 / self.pacer.fps), self.on_motion_tick)
+
+    def on_motion_tick(self):
+        """Moves the textures one step closer to their targets, in low-power mode"""
+        now = time.monotonic()
+        for texture, animation in list(self.animations.items()):
+            size, position, target_size, target_position, start, duration = animation
+            progress = min(1, (now - start) / duration)
+            step = lambda a, b: [x + (y - x) * progress for x, y in zip(a, b)]
+            texture.set_size(*step(size, target_size))
+            texture.set_position(*step(position, target_position))
+            self.tick_at = now
+            if progress >= 1:
+                del self.animations[texture]
+        if not self.animations or not self.app.running:
+            self.motion_tick = None
+            return False
+        return True
+
+    def on_after_paint(self, *args):
+        if self.tick_at is None:
+            return
+        cost = time.monotonic() - self.tick_at
+        self.tick_at = None
+        if not self.pacer.record(cost):
+            return
+        if self.motion_tick:
+            GLib.source_remove(self.motion_tick)
+            self.motion_tick = None
+        if not self.pacer.fps:
+            self.animations.clear()  # the images stay where they are, see motion_mode
+            self.fade_time = min(self.fade_time, SHORT_FADE)
+        elif self.animations:
+            self.start_motion_ticks()
+
+    def toggle(self, texture, visible):
+        texture.set_reactive(visible)
+        texture.save_easing_state()
+        texture.set_easing_mode(
+            Clutter.AnimationMode.EASE_OUT_SINE if visible else Clutter.AnimationMode.EASE_IN_SINE
+        )
+        texture.set_easing_duration(self.fade_time)
+        texture.set_opacity(255 if visible else 0)
+        texture.restore_easing_state()
+        if visible:
+            self.stage.raise_child(texture, None)
+
+
 class VarietySlideshow:
     def current_monitors_help(self):
+        screen = init_display()
+        if screen is None:
+            return ""
         result = "Your current monitors are: "
-        screen = Gdk.Screen.get_default()
         for i in range(0, screen.get_n_monitors()):
             geo = screen.get_monitor_geometry(i)
             result += (", " if i > 0 else "") + "%d - %s, %dx%d" % (
@@ -69,14 +1004,16 @@ class VarietySlideshow:
             )
         return result
 
+    def config_dir(self):
+        return os.path.expanduser("~/.config/variety/")
+
     def load_options(self):
         if "--defaults" in sys.argv:
             self.options = AttrDict()
             return
 
         try:
-            configdir = os.path.expanduser("~/.config/variety/")
-            configfile = os.path.join(configdir, "variety_slideshow.json")
+            configfile = os.path.join(self.config_dir(), "variety_slideshow.json")
             with open(configfile, encoding="utf8") as f:
                 self.options = AttrDict(json.load(f))
         except:
@@ -84,7 +1021,7 @@ class VarietySlideshow:
 
     def save_options(self):
         try:
-            configdir = os.path.expanduser("~/.config/variety/")
+            configdir = self.config_dir()
             try:
                 os.makedirs(configdir)
             except:
@@ -98,7 +1035,8 @@ class VarietySlideshow:
     def parse_options(self):
         """Support for command line options"""
         usage = """%prog [options] [list of images and/or image folders]
-Starts a slideshow using the given images and/or image folders. Options are automatically saved, and reused next time you start the slideshow."""
+Starts a slideshow using the given images and/or image folders. Options are automatically saved, and reused next time you start the slideshow.
+Keys: Right or Page Down - next image, Left, Page Up or Backspace - previous image, Space - pause."""
         parser = optparse.OptionParser(usage=usage)
 
         parser.add_option(
@@ -146,6 +1084,54 @@ Starts a slideshow using the given images and/or image folders. Options are auto
             "0 disables pan." % PAN,
         )
 
+        parser.add_option(
+            "--workers",
+            action="store",
+            type="int",
+            dest="workers",
+            default=self.options.get("workers", WORKERS),
+            help="How many background processes to use for decoding images.\n"
+            "Default is %s.\n"
+            "Integer, at least 1." % WORKERS,
+        )
+
+        parser.add_option(
+            "--prefetch",
+            action="store",
+            type="int",
+            dest="prefetch",
+            default=self.options.get("prefetch", PREFETCH),
+            help="How many upcoming images to keep decoded (or decoding) ahead of time.\n"
+            "Default is %s.\n"
+            "Integer, at least 1." % PREFETCH,
+        )
+
+        parser.add_option(
+            "--cache-size",
+            action="store",
+            type="int",
+            dest="cache_size",
+            default=self.options.get("cache_size", CACHE_SIZE),
+            help="Size limit in megabytes for the on-disk cache of already scaled images, "
+            "kept in ~/.cache/variety-slideshow/.\n"
+            "Default is %s.\n"
+            "Integer, at least 0.\n"
+            "0 disables the cache." % CACHE_SIZE,
+        )
+
+        parser.add_option(
+            "--memory-budget",
+            action="store",
+            type="int",
+            dest="memory_budget",
+            default=self.options.get("memory_budget", 0),
+            help="Memory limit in megabytes for images: the decoded ones waiting for their turn "
+            "and the ones on screen. When it gets close, fewer images are decoded ahead, and if "
+            "that is not enough, they are decoded at a lower resolution. Useful on devices with "
+            "little memory.\n"
+            "Default is 0, no limit.",
+        )
+
         parser.add_option(
             "--sort",
             action="store",
@@ -160,6 +1146,23 @@ name - sort by folder name, then by filename;
 date - sort by file date;""",
         )
 
+        parser.add_option(
+            "--reshuffle",
+            action="store_true",
+            dest="reshuffle",
+            default=self.options.get("reshuffle", False),
+            help="With random order, reshuffle the images every time all of them have been shown, "
+            "instead of repeating the same random order.",
+        )
+
+        parser.add_option(
+            "--dont-reshuffle",
+            action="store_false",
+            dest="reshuffle",
+            default=self.options.get("reshuffle", False),
+            help="Used to reverse the effect of a previous run with --reshuffle.",
+        )
+
         parser.add_option(
             "--order",
             action="store",
@@ -178,6 +1181,18 @@ date - sort by file date;""",
             + self.current_monitors_help(),
         )
 
+        parser.add_option(
+            "--monitors",
+            action="store",
+            type="string",
+            dest="monitors",
+            default=self.options.get("monitors", ""),
+            help="Run on several monitors at once: 'all', or a comma-separated list like 1,3. "
+            "Every monitor gets its own window, order of images and timing, but they share the "
+            "scanned files, the decoding processes and the cache, so this is lighter than running "
+            "one slideshow per monitor. Empty (the default) runs on the single --monitor.",
+        )
+
         parser.add_option(
             "--mode",
             action="store",
@@ -196,6 +1211,19 @@ date - sort by file date;""",
             help="Window title",
         )
 
+        parser.add_option(
+            "--decoder",
+            action="store",
+            type="choice",
+            choices=DECODERS,
+            dest="decoder",
+            default=self.options.get("decoder", DECODER),
+            help="How to decode images: 'gdkpixbuf', or 'pillow', which decodes JPEGs directly at "
+            "a fraction of their size and is much faster for big photos. Other formats always "
+            "use gdkpixbuf. 'pillow' needs the Pillow library (python3-pil). "
+            "Default is '%s': pillow when available, gdkpixbuf otherwise." % DECODER,
+        )
+
         parser.add_option(
             "--hide-from-taskbar",
             action="store_true",
@@ -217,6 +1245,54 @@ date - sort by file date;""",
             "the new default behavior.",
         )
 
+        parser.add_option(
+            "--watch",
+            action="store_true",
+            dest="watch",
+            default=self.options.get("watch", False),
+            help="If specified, the image folders are watched for changes: new images are added to "
+            "the slideshow as they appear, and deleted ones are removed, without restarting.",
+        )
+
+        parser.add_option(
+            "--dont-watch",
+            action="store_false",
+            dest="watch",
+            default=self.options.get("watch", False),
+            help="Used to reverse the effect of a previous run with --watch.",
+        )
+
+        parser.add_option(
+            "--stats",
+            action="store",
+            type="string",
+            dest="stats",
+            default=self.options.get("stats", ""),
+            help="Export performance stats: every %d seconds a JSON line with per-slide timings "
+            "over the last slides, counters of skipped files and late slides, and the decode "
+            "queue depth. Either a file to append to, or unix:/path/to/socket to serve them to "
+            "whoever connects to that UNIX socket. Empty (the default) disables it."
+            % STATS_INTERVAL,
+        )
+
+        parser.add_option(
+            "--low-power",
+            action="store_true",
+            dest="low_power",
+            default=self.options.get("low_power", False),
+            help="Save power on devices that run the slideshow all the time: pan and zoom are "
+            "updated only %d times per second, less if the device can't keep up with that, "
+            "and are turned off (leaving a short fade) if it can't keep up at all." % LOW_POWER_FPS,
+        )
+
+        parser.add_option(
+            "--dont-low-power",
+            action="store_false",
+            dest="low_power",
+            default=self.options.get("low_power", False),
+            help="Used to reverse the effect of a previous run with --low-power.",
+        )
+
         parser.add_option(
             "--defaults",
             action="store_true",
@@ -255,6 +1331,28 @@ date - sort by file date;""",
         if self.options.pan < 0:
             parser.error("Pan should be at least 0")
 
+        if self.options.workers < 1:
+            parser.error("Workers should be at least 1")
+
+        if self.options.prefetch < 1:
+            parser.error("Prefetch should be at least 1")
+
+        if self.options.cache_size < 0:
+            parser.error("Cache size should be at least 0")
+
+        if self.options.memory_budget < 0:
+            parser.error("Memory budget should be at least 0")
+
+        paths = [os.path.abspath(os.path.expanduser(arg)) for arg in self.options.files_and_folders]
+        if not any(is_image(path) or os.path.isdir(path) for path in paths):
+            parser.error("You should specify some files or folders")
+
+        self.options.monitors = self.options.monitors.strip().lower()
+        if self.options.monitors not in ("", "all") and not all(
+            i.strip().isdigit() for i in self.options.monitors.split(",")
+        ):
+            parser.error("Monitors should be 'all' or a comma-separated list of monitor numbers")
+
         self.options.mode = self.options.mode.lower()
         if self.options.mode not in (
             "fullscreen",
@@ -271,349 +1369,351 @@ date - sort by file date;""",
 
         self.parser = parser
 
-    def prepare_file_queues(self):
-        self.queued = []
-        self.files = []
-        self.error_files = set()
-        self.cursor = 0
-
-        for arg in self.options.files_and_folders:
-            path = os.path.abspath(os.path.expanduser(arg))
-            if is_image(path):
-                self.files.append(path)
-
-            elif os.path.isdir(path):
-                for root, dirnames, filenames in os.walk(path):
-                    for filename in filenames:
-                        full_path = os.path.join(root, filename)
-                        if is_image(full_path):
-                            self.files.append(full_path)
-                        if len(self.files) > 2000:
-                            break
-                    else:
-                        continue
-                    break
-                else:
-                    continue
-                break
+    def prepare_file_queues(self, screen, monitors):
+        self.files = FileTable()
+        self.windows = []
+        for monitor in monitors:
+            # until the window is up and sized, its images are decoded for the whole monitor
+            rect = self.monitor_geometry(screen, monitor)
+            self.windows.append(self.new_window(monitor, (rect.width, rect.height)))
+        self.scan_done = False
+        self.monitors = {}  # folder -> Gio.FileMonitor, with --watch
+
+        paths = [os.path.abspath(os.path.expanduser(arg)) for arg in self.options.files_and_folders]
+
+        # With random order we can start showing images from the first scanned batch, the rest are
+        # shuffled into the unplayed part of the list as they come. Sorted orders need all files.
+        self.stream_files = self.options.sort.lower() == "random"
+
+        scan_thread = threading.Thread(target=self.scan_files, args=(paths,))
+        scan_thread.daemon = True
+        scan_thread.start()
 
-        if not self.files:
-            self.parser.error("You should specify some files or folders")
+    def scan_files(self, paths):
+        """Runs in a background thread, hands the found files to the main loop"""
+        try:
+            index = FolderIndex(os.path.join(self.config_dir(), "variety_slideshow_index.json"))
+            index.load()
+            if self.stream_files:
+                for batch in scan(paths, index):
+                    if not self.running:
+                        return
+                    GLib.idle_add(self.add_files, self.bad_files.filter(batch))
+            else:
+                files = [f for batch in scan(paths, index) for f in self.bad_files.filter(batch)]
+                self.sort_files(files)
+                GLib.idle_add(self.add_files, files)
+            GLib.idle_add(self.bad_files.forget, self.bad_files.gone())
+            index.save(paths)
+            if self.options.watch:
+                GLib.idle_add(self.watch_folders, list(index.scanned))
+        except:
+            logging.exception("Could not scan files:")
+        GLib.idle_add(self.on_scan_done)
 
+    def sort_files(self, files):
+        """Sorts a list of (path, size, mtime) as requested by the options"""
         sort = self.options.sort.lower()
         if sort == "keep":
             pass
         elif sort == "name":
-            self.files.sort()
+            files.sort()
         elif sort == "date":
-            self.files.sort(key=os.path.getmtime)
-        else:
-            random.shuffle(self.files)
+            files.sort(key=lambda f: f[2])
 
         if self.options.sort_order.lower().startswith("desc"):
-            self.files.reverse()
+            files.reverse()
+
+    def add_files(self, files):
+        """Adds a list of (path, size, mtime) to the file table and to the windows' playlists"""
+        # scan results are distinct and the table only has earlier batches of the same scan
+        added = [self.files.append(*f) for f in files]
+        for window in self.windows:
+            window.playlist.add(added, shuffle=self.stream_files)
+            # also before the slideshow has started, to get the first images decoding early
+            window.prepare_next_data()
+
+    def on_scan_done(self):
+        self.scan_done = True
+        if not len(self.files):
+            logging.error("Could not find any images in the specified files and folders, exiting.")
+            self.quit()
+
+    def watch_folders(self, folders):
+        for folder in folders:
+            if folder in self.monitors:
+                continue
+            try:
+                monitor = Gio.File.new_for_path(folder).monitor_directory(
+                    Gio.FileMonitorFlags.WATCH_MOVES, None
+                )
+            except GLib.Error:
+                logging.warning("Could not watch folder %s for changes" % folder)
+                continue
+            monitor.connect("changed", self.on_folder_changed)
+            self.monitors[folder] = monitor
 
-    def get_next_file(self):
+    def on_folder_changed(self, monitor, file, other_file, event):
         if not self.running:
-            return None
-        if len(self.queued):
-            return self.queued.pop(0)
+            return
+        path = file.get_path()
+        if event in (Gio.FileMonitorEvent.DELETED, Gio.FileMonitorEvent.MOVED_OUT):
+            self.path_removed(path)
+        elif event == Gio.FileMonitorEvent.RENAMED:
+            self.path_removed(path)
+            self.path_added(other_file.get_path())
+        elif event in (Gio.FileMonitorEvent.CHANGES_DONE_HINT, Gio.FileMonitorEvent.MOVED_IN):
+            self.path_added(path)
+        elif event == Gio.FileMonitorEvent.CREATED and os.path.isdir(path):
+            self.path_added(path)
+
+    def path_added(self, path):
+        if os.path.isdir(path):
+            if path not in self.monitors:
+                threading.Thread(target=self.scan_new_folder, args=(path,), daemon=True).start()
+        elif is_image(path):
+            try:
+                st = os.stat(path)
+            except OSError:
+                return
+            file_id = self.files.find(path)
+            if file_id is not None:
+                self.files.clear_error(file_id)  # it changed, so give it another chance
+            self.add_new_files([(path, st.st_size, st.st_mtime)])
+
+    def scan_new_folder(self, folder):
+        """Runs in a background thread for folders that appear while watching"""
+        index = FolderIndex(None)  # not persisted, used to collect the subfolders
+        files = [f for batch in scan([folder], index) for f in self.bad_files.filter(batch)]
+        GLib.idle_add(self.on_new_folder_scanned, files, list(index.scanned))
+
+    def on_new_folder_scanned(self, files, folders):
+        self.watch_folders(folders)
+        self.add_new_files(files)
+
+    def add_new_files(self, files):
+        """Like add_files, but for single files that appear while watching, after the scan"""
+        for f in files:
+            file_id, is_new = self.files.add(*f)
+            if is_new:
+                for window in self.windows:
+                    window.playlist.insert(file_id)  # revived ids are still in the playlists
+        for window in self.windows:
+            if window.started:
+                window.prepare_next_data()
+
+    def path_removed(self, path):
+        if path in self.monitors:
+            prefix = path + os.sep
+            for folder in list(self.monitors):
+                if folder == path or folder.startswith(prefix):
+                    self.monitors.pop(folder).cancel()
+            removed = set(self.files.remove_folder(path))
         else:
-            if self.error_files == set(self.files):
-                logging.error("Could not find any non-corrupt images, exiting.")
-                self.quit()
-                return None
-
-            f = self.files[self.cursor]
-            self.cursor = (self.cursor + 1) % len(self.files)
-            if f in self.error_files:
-                return self.get_next_file()
-            else:
-                return f
-
-    def queue(self, filename):
-        self.queued.append(filename)
-
-    def connect_signals(self):
-        # Connect signals
-        def on_button_press(*args):
-            if self.current_mode == "fullscreen" and not self.mode_was_changed:
-                self.quit()
-
-        def on_motion(*args):
-            if (
-                self.options.quit_on_motion
-                and self.current_mode == "fullscreen"
-                and not self.mode_was_changed
-            ):
-                self.quit()
-
-        def on_key_press(widget, event):
-            if self.current_mode == "fullscreen" and not self.mode_was_changed:
-                self.quit()
+            file_id = self.files.find(path)
+            if file_id is None:
                 return
+            self.files.remove(file_id)
+            removed = {file_id}
+
+        for window in self.windows:
+            window.evict(removed)
+
+    def get_monitors(self, screen):
+        """The monitors to run on, numbered from 1, as requested with --monitors or --monitor"""
+        count = screen.get_n_monitors()
+        if self.options.monitors == "all":
+            return list(range(1, count + 1))
+        if self.options.monitors:
+            requested = [int(i) for i in self.options.monitors.split(",")]
+        else:
+            requested = [self.options.monitor]
+        return sorted(set(max(1, min(i, count)) for i in requested))
 
-            key = Gdk.keyval_name(event.keyval)
-
-            if key == "Escape":
-                self.quit()
-
-            elif key in ("f", "F", "F11"):
-                if self.current_mode == "desktop":
-                    return
-                if self.current_mode == "fullscreen":
-                    self.current_mode = "window"
-                    self.window.unfullscreen()
-                else:
-                    self.current_mode = "fullscreen"
-                    self.window.fullscreen()
-                self.mode_was_changed = True
-                GObject.timeout_add(200, self.go_next)
-
-            elif key in ("d", "D"):
-                if self.current_mode == "undecorated":
-                    self.current_mode = "window"
-                    self.window.set_decorated(True)
-                else:
-                    self.current_mode = "undecorated"
-                    self.window.set_decorated(False)
-
-        self.window.connect("delete-event", self.quit)
-        self.stage.connect("destroy", self.quit)
-        self.stage.connect("key-press-event", on_key_press)
-        self.stage.connect("button-press-event", on_button_press)
-        self.stage.connect("motion-event", on_motion)
+    def new_window(self, monitor, monitor_size):
+        return SlideshowWindow(self, monitor, monitor_size)
 
     def run(self):
         self.running = True
 
-        self.window = Gtk.Window()
-
         self.load_options()  # loads from config file
         self.parse_options()  # parses the command-line arguments, these take precedence over the saved config
         self.save_options()
-        self.prepare_file_queues()
-
-        self.window.set_title(self.options.title)
-        self.screen = self.window.get_screen()
-
-        self.embed = GtkClutter.Embed()
-        self.window.add(self.embed)
-        self.embed.set_visible(True)
-
-        self.stage = self.embed.get_stage()
-        self.stage.set_color(Clutter.Color.get_static(Clutter.StaticColor.BLACK))
-        if self.options.mode == "fullscreen":
-            self.stage.hide_cursor()
-
-        self.texture = Clutter.Texture.new()
-        self.next_texture = None
-        self.prev_texture = None
-        self.data_queue = Queue()
-
-        self.connect_signals()
-
-        self.will_enlarge = random.choice((True, False))
-
-        self.window.resize(600, 400)
-        self.move_to_monitor(self.options.monitor)
 
-        self.current_mode = self.options.mode
-        self.mode_was_changed = False
-        if self.options.mode == "fullscreen":
-            self.window.fullscreen()
-            self.window.set_skip_taskbar_hint(True)
-        elif self.options.mode == "maximized":
-            self.window.maximize()
-        elif self.options.mode == "desktop":
-            self.window.maximize()
-            self.window.set_decorated(False)
-            self.window.set_keep_below(True)
-
-            # ensure window will get deiconified (i.e. unminimized) after "Show Desktop" button/shortcut
-            def _window_state_changed(window, event, *args):
-                if event.new_window_state & Gdk.WindowState.ICONIFIED:
-                    self.window.deiconify()
-                    self.window.present()
-
-            self.window.connect("window-state-event", _window_state_changed)
-
-        elif self.options.mode == "undecorated":
-            self.window.set_decorated(False)
+        screen = init_display()
+        if screen is None:
+            logging.error("Could not open the display, exiting.")
+            sys.exit(1)
+        monitors = self.get_monitors(screen)
 
-        if self.options.hide_from_taskbar:
-            self.window.set_skip_taskbar_hint(True)
+        cache = None
+        if self.options.cache_size > 0:
+            try:
+                cache = ScaledImageCache(
+                    os.path.expanduser("~/.cache/variety-slideshow/scaled/"),
+                    self.options.cache_size * 1024 * 1024,
+                )
+            except OSError:
+                logging.exception("Could not create the scaled image cache, running without it:")
+
+        # one slot per prefetched image, one spare per window so a restarted worker never waits for
+        # a slot
+        self.decode_pool = DecodePool(
+            self.options.workers,
+            slots=(self.options.prefetch + 1) * len(monitors),
+            cache=cache,
+            decoder=self.options.decoder,
+        )
+        if self.options.decoder == "pillow" and self.decode_pool.decoder != "pillow":
+            logging.warning("Pillow is not installed, decoding with gdkpixbuf instead")
+        self.decode_pool.start()
+        self.thumbnails = ThumbnailReader()  # a thread, so only after forking the workers
+        self.governor = MemoryGovernor(self.options.memory_budget * MB, self.options.prefetch)
+        self.memory_logged_at = time.monotonic()
+        GLib.timeout_add_seconds(MEMORY_CHECK_INTERVAL, self.check_memory)
+
+        self.stats = SlideStats()
+        self.stats_writer = None
+        if self.options.stats:
+            try:
+                self.stats_writer = StatsWriter(self.options.stats)
+                if self.stats_writer.fileno() is not None:
+                    GLib.io_add_watch(
+                        self.stats_writer.fileno(),
+                        GLib.PRIORITY_DEFAULT,
+                        GLib.IO_IN,
+                        lambda *args: self.stats_writer.accept() or True,
+                    )
+                GLib.timeout_add_seconds(STATS_INTERVAL, self.write_stats)
+            except OSError:
+                logging.exception("Could not export stats to %s:" % self.options.stats)
+
+        # decoded frames reach us through the main loop, go_next never blocks on the workers;
+        # the timeout is there to notice crashed workers even when no results are coming in
+        GLib.io_add_watch(
+            self.decode_pool.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, self.on_decode_results
+        )
+        GLib.timeout_add_seconds(1, self.on_decode_results)
+
+        # files that failed to decode in earlier runs are left out while scanning
+        bad_files_path = os.path.join(self.config_dir(), "variety_slideshow_bad_files.json")
+        self.bad_files = BadFiles(bad_files_path)
+        self.bad_files.load()
+
+        # the decode workers are forked above, before we start any threads
+        self.first_image_shown = False
+        self.prepare_file_queues(screen, monitors)
+
+        # Initializing Clutter and creating the window take a while: let the first scanned files
+        # reach the decode workers in between, so the first image decodes in the meantime.
+        self.process_pending_events()
+        if self.options.low_power:
+            # caps Clutter's own animations too - the fades - with backends that don't sync them
+            # to the display
+            os.environ.setdefault("CLUTTER_DEFAULT_FPS", str(LOW_POWER_FPS))
+        init_toolkit()
+        self.process_pending_events()
+        if not self.running:
+            return
 
-        def after_show(*args):
-            def f():
-                self.move_to_monitor(self.options.monitor)
-                self.prepare_next_data()
-                self.go_next()
+        for window in self.windows:
+            window.create()
+        self.process_pending_events()
+        if not self.running:
+            return
+        for window in self.windows:
+            window.show()
+        Gtk.main()
 
-            GObject.timeout_add(200, f)
+    def process_pending_events(self):
+        """Dispatches what is pending in the main loop, for use before Gtk.main runs it"""
+        context = GLib.MainContext.default()
+        while self.running and context.pending():
+            context.iteration(False)
 
-        self.window.connect("show", lambda *args: GObject.idle_add(after_show))
-        self.window.show()
-        Gtk.main()
+    def on_signal(self):
+        if self.running:
+            self.quit()
+        return True
 
     def quit(self, *args):
         logging.info("Exiting...")
         self.running = False
-        Gtk.main_quit()
-
-    def move_to_monitor(self, i):
-        i = max(1, min(i, self.screen.get_n_monitors()))
-        rect = self.screen.get_monitor_geometry(i - 1)
-        self.window.move(
-            rect.x + (rect.width - self.window.get_size()[0]) / 2,
-            rect.y + (rect.height - self.window.get_size()[1]) / 2,
-        )
-
-    def go_next(self, *args):
+        self.decode_pool.shutdown()
+        if self.stats_writer:
+            self.stats_writer.close()
+        if Gtk and Gtk.main_level():
+            Gtk.main_quit()
+
+    def monitor_geometry(self, screen, i):
+        """Geometry of monitor i, numbered from 1 and clamped to the available ones"""
+        i = max(1, min(i, screen.get_n_monitors()))
+        return screen.get_monitor_geometry(i - 1)
+
+    def write_stats(self):
         if not self.running:
-            return
-        try:
-            if hasattr(self, "next_timeout"):
-                GObject.source_remove(self.next_timeout)
-                delattr(self, "next_timeout")
-
-            image_data = self.data_queue.get(True, timeout=1)
-            if not isinstance(image_data, tuple):
-                if image_data:
-                    logging.info("Error in %s, skipping it" % image_data)
-                    self.error_files.add(image_data)
-                self.prepare_next_data()
-                return self.go_next()
-
-            self.next_texture = self.create_texture(image_data)
-            target_size, target_position = self.initialize_pan_and_zoom(self.next_texture)
-
-            self.stage.add_actor(self.next_texture)
-            self.toggle(self.texture, False)
-            self.toggle(self.next_texture, True)
-
-            self.start_pan_and_zoom(self.next_texture, target_size, target_position)
-
-            if self.prev_texture:
-                self.prev_texture.destroy()
-            self.prev_texture = self.texture
-            self.texture = self.next_texture
-
-            self.next_timeout = GObject.timeout_add(
-                int(self.interval), self.go_next, priority=GLib.PRIORITY_HIGH
+            return False
+        self.stats.counters["worker_restarts"] = self.decode_pool.restarts
+        self.stats_writer.write(
+            self.stats.summary(
+                pipeline=sum(len(window.pipeline) for window in self.windows),
+                decode_queue=self.decode_pool.queue_length(),
+                files=len(self.files),
+                memory_mb=round(sum(self.memory_usage().values()) / MB, 1),
+                good_files=self.files.good,
+                startup_ms=round(self.startup_time * 1000) if self.first_image_shown else None,
             )
-            self.prepare_next_data()
-        except:
-            logging.exception("Oops, exception in next, rescheduling:")
-            self.next_timeout = GObject.timeout_add(100, self.go_next, priority=GLib.PRIORITY_HIGH)
-
-    def get_ratio_to_screen(self, texture):
-        return max(
-            self.stage.get_width() / texture.get_width(),
-            self.stage.get_height() / texture.get_height(),
-        )
-
-    def prepare_next_data(self):
-        filename = self.get_next_file()
-        if not filename:
-            self.data_queue.put(None)
-            return
-
-        def _prepare(filename):
-            os.nice(20)
-            max_w = self.stage.get_width() * (1 + 2 * self.options.zoom)
-            max_h = self.stage.get_height() * (1 + 2 * self.options.zoom)
-
-            try:
-                pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(filename, max_w, max_h, True)
-                data = (
-                    pixbuf.get_pixels(),
-                    pixbuf.get_has_alpha(),
-                    pixbuf.get_width(),
-                    pixbuf.get_height(),
-                    pixbuf.get_rowstride(),
-                    4 if pixbuf.get_has_alpha() else 3,
-                )
-                self.data_queue.put(data)
-            except:
-                logging.exception("Could not open file %s" % filename)
-                self.data_queue.put(filename)
-
-        p = Process(target=_prepare, args=(filename,))
-        p.daemon = True
-        p.start()
-
-    def create_texture(self, image_data):
-        data = tuple(image_data) + (Clutter.TextureFlags.NONE,)
-        texture = Clutter.Texture.new()
-        texture.set_from_rgb_data(*data)
-        texture.set_opacity(0)
-        texture.set_keep_aspect_ratio(True)
-        return texture
-
-    def initialize_pan_and_zoom(self, texture):
-        self.will_enlarge = not self.will_enlarge
-
-        pan_px = max(self.stage.get_width(), self.stage.get_height()) * self.options.pan
-        rand_pan = lambda: random.choice((-1, 1)) * (pan_px + pan_px * random.random())
-        zoom_factor = (1 + self.options.zoom) * (1 + self.options.zoom * random.random())
-
-        scale = self.get_ratio_to_screen(texture)
-        base_w, base_h = texture.get_width() * scale, texture.get_height() * scale
-
-        safety_zoom = 1 + self.options.pan / 2 if self.options.zoom > 0 else 1
-
-        small_size = base_w * safety_zoom, base_h * safety_zoom
-        big_size = base_w * safety_zoom * zoom_factor, base_h * safety_zoom * zoom_factor
-        small_position = (
-            -(small_size[0] - self.stage.get_width()) / 2,
-            -(small_size[1] - self.stage.get_height()) / 2,
-        )
-        big_position = (
-            -(big_size[0] - self.stage.get_width()) / 2 + rand_pan(),
-            -(big_size[1] - self.stage.get_height()) / 2 + rand_pan(),
         )
+        return True
 
-        if self.will_enlarge:
-            initial_size, initial_position = small_size, small_position
-            target_size, target_position = big_size, big_position
-        else:
-            initial_size, initial_position = big_size, big_position
-            target_size, target_position = small_size, small_position
-
-        # set initial size
-        texture.set_size(*initial_size)
-        texture.set_position(*initial_position)
-
-        return target_size, target_position
-
-    def start_pan_and_zoom(self, texture, target_size, target_position):
-        # start animating to target size
-        texture.save_easing_state()
-        texture.set_easing_mode(Clutter.AnimationMode.LINEAR)
-        texture.set_easing_duration(self.interval + self.fade_time)
-        texture.set_size(*target_size)
-        texture.set_position(*target_position)
+    def memory_usage(self):
+        return {
+            "decoded": self.decode_pool.memory_size(),
+            "textures": sum(window.texture_bytes() for window in self.windows),
+            "history": sum(window.history_bytes() for window in self.windows),
+        }
 
-    def toggle(self, texture, visible):
-        texture.set_reactive(visible)
-        texture.save_easing_state()
-        texture.set_easing_mode(
-            Clutter.AnimationMode.EASE_OUT_SINE if visible else Clutter.AnimationMode.EASE_IN_SINE
-        )
-        texture.set_easing_duration(self.fade_time)
-        texture.set_opacity(255 if visible else 0)
-        if visible:
-            self.stage.raise_child(texture, None)
+    def check_memory(self):
+        if not self.running:
+            return False
+        usage = self.memory_usage()
+        if time.monotonic() - self.memory_logged_at >= MEMORY_LOG_INTERVAL:
+            self.memory_logged_at = time.monotonic()
+            logging.warning("Memory used by images: %s" % format_usage(usage))
+        frame_bytes = max(window.frame_bytes() for window in self.windows)
+        if self.governor.update(sum(usage.values()), frame_bytes):
+            for window in self.windows:
+                window.trim_pipeline()
+                del window.history[:]
+            self.decode_pool.shrink()
+        return True
+
+    def on_decode_results(self, *args):
+        if not self.running:
+            return False
+        for job_id, filename, frame, failure in self.decode_pool.collect():
+            for window in self.windows:
+                if job_id in window.pending_slides:
+                    window.on_decoded(job_id, filename, frame, failure)
+                    break
+            else:
+                if frame:
+                    self.decode_pool.release(frame)
+        # also when nothing arrived: a decode can become late just by taking long
+        for window in self.windows:
+            window.schedule_staging()
+        return True
 
 
 def main():
-    # Ctrl-C
-    signal.signal(signal.SIGINT, signal.SIG_DFL)
-    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # Ctrl-C and kill quit through the main loop, so the decode workers and their shared memory
+    # are cleaned up too
+    slideshow = VarietySlideshow()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        GLib.unix_signal_add(GLib.PRIORITY_HIGH, signum, slideshow.on_signal)
     signal.signal(signal.SIGQUIT, signal.SIG_DFL)
 
-    VarietySlideshow().run()
+    slideshow.run()
 
 
 if __name__ == "__main__":